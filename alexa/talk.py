@@ -1,17 +1,20 @@
 from io import StringIO
 import os
+import time
 
 import arrow
 
 import lambdaskill.utils as utils
 from lambdaskill import *
 from tivotalk.server.pubcom import Communicator
+from tivotalk.server.transport import transport_from_config
+import tivotalk.server.wire as wire
 
-PUBKEY = os.environ['TT_PUBKEY']
-SUBKEY = os.environ['TT_SUBKEY']
-CLIENT_ID = os.environ['TT_CLIENT_ID']
 SKILL_ID = os.environ['TT_SKILL_ID']
 
+# Created once per container so warm invocations reuse the live subscription.
+COM = Communicator(transport=transport_from_config(os.environ))
+
 
 class CommandError(Exception):
     pass
@@ -32,7 +35,7 @@ class TiVoTalk(Skill):
     def __init__(self):
         Skill.__init__(self)
         self._app_id = SKILL_ID
-        self.com = Communicator(pub_key=PUBKEY, sub_key=SUBKEY, client_id=CLIENT_ID)
+        self.com = COM
 
     def on_launch_request(self, request):
         logger.info('Received Launch Request.')
@@ -44,7 +47,7 @@ class TiVoTalk(Skill):
     def handler(self, event, context):
         try:
             return Skill.handler(self, event=event, context=context)
-        except CommandError:
+        except (CommandError, TimeoutError):
             req = Request.wrap(event)
             resp = Response.respond("An error occurred processing your request.  "
                                     "Please state your request again.").add_reprompt()
@@ -54,44 +57,60 @@ class TiVoTalk(Skill):
             resp = Response.finish("Failed to connect to TiVo Proxy.  Try again in a few moments.")
             return resp.prepare(session_attributes=req.session_attributes)
 
+    def connect(self):
+        t0 = time.perf_counter()
+        connected, fast = self.com.ensure_connected(timeout=1.0)
+        if not connected:
+            raise ConnectionError('Failed to connect to remote server.')
+        return t0, fast
+
+    def record_round_trip(self, message, t0, fast):
+        stats = self.com.round_trips
+        stats.record(time.perf_counter() - t0, fast)
+        summary = stats.summary()
+        logger.info('{} round trip {:.0f} ms ({} path); p50 {:.0f} ms, p99 {:.0f} ms over {:d} calls'.format(
+            message['cmd'], stats.samples[-1] * 1000, 'fast' if fast else 'connect',
+            summary['p50'] * 1000, summary['p99'] * 1000, summary['count']))
+
     def exec_list_cmd(self, message, list_key):
-        com = self.com
-        com.connect()
-        if com.connected.wait(timeout=1.0):
-            com.publish(message=message)
-            resp = com.wait_for_message(timeout=3.0).message
-            if resp['cmd'] == message['cmd'] and resp['status'] == 'SUCCESS':
-                count = resp['total_count']
-                items = []
-                while True:
-                    items.extend(resp[list_key])
-                    if len(items) >= count:
-                        break
-                    resp = com.wait_for_message(timeout=3.0).message
-                return items
-            raise CommandError('An error occured while executing the command.')
-        raise ConnectionError('Failed to connect to remote server.')
+        t0, fast = self.connect()
+        # Chunks carry seq numbers and may arrive out of order; items are
+        # appended as soon as the chunks before them are in.
+        items = []
+        early = {}
+        next_seq = 0
+        last_seq = None
+        with self.com.request(dict(message, v=wire.VERSION)) as call:
+            while last_seq is None or next_seq <= last_seq:
+                resp = call.get(timeout=3.0)
+                if resp['status'] != 'SUCCESS':
+                    raise CommandError('An error occured while executing the command.')
+                if 'seq' not in resp:
+                    items = wire.unpack_list(resp[list_key])
+                    break
+                if resp.get('last'):
+                    last_seq = resp['seq']
+                early[resp['seq']] = wire.unpack_list(resp[list_key])
+                while next_seq in early:
+                    items.extend(early.pop(next_seq))
+                    next_seq += 1
+        self.record_round_trip(message, t0, fast)
+        return items
 
     def exec_cmd_check(self, message):
-        com = self.com
-        com.connect()
-        if com.connected.wait(timeout=1.0):
-            com.publish(message=message)
-            resp = com.wait_for_message(timeout=3.0).message
-            if resp['cmd'] == message['cmd'] and resp['status'] == 'SUCCESS':
-                if 'payload' in resp:
-                    return resp['payload']
-                return
-            raise CommandError('An error occurred while executing the command.')
-        raise ConnectionError('Failed to connect to remote server.')
+        t0, fast = self.connect()
+        with self.com.request(message) as call:
+            resp = call.get(timeout=3.0)
+        if resp['status'] == 'SUCCESS':
+            self.record_round_trip(message, t0, fast)
+            if 'payload' in resp:
+                return resp['payload']
+            return
+        raise CommandError('An error occurred while executing the command.')
 
     def exec_cmd(self, message):
-        com = self.com
-        com.connect()
-        if com.connected.wait(timeout=1.0):
-            com.publish(message=message)
-            return
-        raise ConnectionError('Failed to connect to remote server.')
+        self.connect()
+        self.com.publish(message=message)
 
     def do_whatsonintent(self, request):
         """Queries the TiVo to find out what its going to record.
@@ -107,7 +126,7 @@ class TiVoTalk(Skill):
                                         list_key='recordings')
         titles = [r[0] for r in recordings]
         output = "I'm recording the following items: {}".format(utils.sequence_to_oxford_string(titles))
-        request.session_attributes['content'] = recordings
+        request.session_attributes['content'] = wire.pack_list('recordings', recordings)
         return Response.respond(output=output).add_card(title='ToDo:')
 
     def do_whenisintent(self, request):
@@ -132,7 +151,7 @@ class TiVoTalk(Skill):
                                     list_key='offers')
         if not offers:
             return Response.respond("I did not find any showings of {}.".format(title))
-        request.session_attributes['content'] = offers
+        request.session_attributes['content'] = wire.pack_list('offers', offers)
         showings = []
         for o in offers:
             start = arrow.get(o['startTime']).replace(tzinfo='UTC').to('US/Eastern')
@@ -158,7 +177,7 @@ class TiVoTalk(Skill):
                                     "Please try that request again.").add_reprompt()
         if 'content' not in request.session_attributes:
             return Response.respond("You must ask about upcoming shows before asking for details.")
-        content = request.session_attributes['content']
+        content = wire.unpack_list(request.session_attributes['content'])
         ids = [i for t, i in content if t.lower() == title.lower()]
         if len(ids) < 1:
             return Response.respond("The requested title is not in the results of the most recent search.")
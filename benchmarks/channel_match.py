@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Compares process.extractOne over all HDTV channel names with ChannelIndex.
+
+Run from the project root:
+
+    python -m benchmarks.channel_match [--channels N] [--queries N] [--lineup channels.json]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from fuzzywuzzy import fuzz, process
+
+from tivotalk.server.channels import ChannelIndex, Lineup
+
+
+NETWORKS = ['ABC', 'CBS', 'NBC', 'FOX', 'PBS', 'ESPN', 'HBO', 'Showtime', 'Starz', 'Cinemax', 'Discovery',
+            'History', 'Food Network', 'HGTV', 'Comedy Central', 'Cartoon Network', 'Nickelodeon', 'Disney',
+            'AMC', 'TNT', 'TBS', 'USA', 'Syfy', 'Bravo', 'CNN', 'MSNBC', 'Fox News', 'Weather', 'Golf', 'NFL']
+SUFFIXES = ['', ' 2', ' East', ' West', ' Plus', ' Family', ' Kids', ' Latino', ' Classic', ' Sports']
+
+
+def synthetic_lineup(count, seed=0):
+    rnd = random.Random(seed)
+    channels = []
+    for n in range(count):
+        name = '{}{} {:d}HD'.format(rnd.choice(NETWORKS), rnd.choice(SUFFIXES), n)
+        channels.append({'channelNumber': str(100 + n), 'name': name, 'callSign': name.replace(' ', '')[:8].upper(),
+                         'stationId': 'tivo:st.{:d}'.format(n), 'isHdtv': True, 'isReceived': True})
+    return channels
+
+
+def spoken(name, rnd):
+    words = name.lower().replace('hd', '').split()
+    if len(words) > 1 and rnd.random() < 0.3:
+        words.pop(rnd.randrange(len(words)))
+    text = ' '.join(words)
+    if len(text) > 4 and rnd.random() < 0.3:
+        i = rnd.randrange(len(text))
+        text = text[:i] + text[i + 1:]
+    return text
+
+
+def extract_one(channels, query):
+    options = [c['name'] for c in channels if c['isHdtv'] and c['isReceived']]
+    return process.extractOne(query, options)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--lineup', help='channels.json saved by the proxy')
+    args = parser.parse_args()
+
+    if args.lineup:
+        with open(args.lineup, 'rt') as cf:
+            channels = json.load(cf)
+    else:
+        channels = synthetic_lineup(args.channels)
+    rnd = random.Random(1)
+    hd = [c for c in channels if c['isHdtv'] and c['isReceived']]
+    queries = [spoken(rnd.choice(hd)['name'], rnd) for _ in range(args.queries)]
+
+    t0 = time.perf_counter()
+    expected = [extract_one(channels, q) for q in queries]
+    legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    index = ChannelIndex(Lineup.from_channels(channels))
+    build = time.perf_counter() - t0
+
+    index.memo_size = 0
+    t0 = time.perf_counter()
+    found = [index.match('c_name', q).name for q in queries]
+    cold = time.perf_counter() - t0
+
+    index.memo_size = len(queries)
+    for q in queries:
+        index.match('c_name', q)
+    t0 = time.perf_counter()
+    for q in queries:
+        index.match('c_name', q)
+    memo = time.perf_counter() - t0
+
+    agree = sum(1 for a, b in zip(expected, found) if a == b)
+    # extractOne breaks ties by lineup order, the index by trigram overlap.
+    ties = sum(1 for q, a, b in zip(queries, expected, found) if a != b and fuzz.WRatio(q, a) == fuzz.WRatio(q, b))
+    print("{:d} HDTV channels, {:d} queries".format(len(hd), len(queries)))
+    print("extractOne     : {:9.3f} ms/lookup".format(legacy * 1000 / len(queries)))
+    print("index build    : {:9.3f} ms".format(build * 1000))
+    print("index (no memo): {:9.3f} ms/lookup".format(cold * 1000 / len(queries)))
+    print("index (memo)   : {:9.3f} ms/lookup".format(memo * 1000 / len(queries)))
+    print("agreement      : {:d}/{:d} same channel, {:d} equal-score ties".format(agree, len(queries), ties))
+
+
+if __name__ == '__main__':
+    main()
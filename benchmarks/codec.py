@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Compares the installed MRPC JSON codecs and the cached request header path.
+
+Run from the project root:
+
+    python -m benchmarks.codec [--capture FILE] [--size-mb N]
+
+FILE is a raw capture of MRPC/2 response frames; without one synthetic
+channelSearch responses are generated.
+"""
+
+import argparse
+import json
+import time
+
+import tivotalk.mind.rpc as rpc
+from benchmarks.frame_reader import ReplaySocket, split_capture, synthetic_capture
+
+
+def legacy_encode(session, rpc_id, req_type, payload_json):
+    eol = '\r\n'
+    header_tuples = (
+        ("Type", "request"),
+        ("RpcId", "{:d}".format(rpc_id)),
+        ("SchemaVersion", "{}".format(session.schema_version)),
+        ("Content-Type", "application/json"),
+        ("RequestType", req_type),
+        ("ResponseCount", session.response_count[False]),
+        ("BodyId", payload_json.get("bodyId", "")),
+        ("X-ApplicationName", "Quicksilver"),
+        ("X-ApplicationVersion", "1.2"),
+        ("X-ApplicationSessionId", "0x{:x}".format(session.session_id)),
+    )
+    headers = eol.join(["{}: {}".format(k, v) for k, v in header_tuples]) + eol
+    payload_json['type'] = req_type
+    payload = json.dumps(payload_json)
+    preamble = "MRPC/2 {:d} {:d}".format(len(headers) + 2, len(payload))
+    return (preamble + eol + headers + eol + payload + "\n").encode('ascii')
+
+
+def decode_all(frames, loads):
+    t0 = time.perf_counter()
+    for frame in frames:
+        rpc.MRPCFrameReader(ReplaySocket(frame)).read_frame(loads)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--capture', help='raw MRPC/2 response capture')
+    parser.add_argument('--size-mb', type=float, default=4.0, help='synthetic capture size')
+    parser.add_argument('--requests', type=int, default=20000, help='requests to encode')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as cf:
+            frames = split_capture(cf.read())
+    else:
+        frames = synthetic_capture(args.size_mb, 50)
+    mb = sum(len(f) for f in frames) / 2**20
+    print("{:d} frames, {:.2f} MiB".format(len(frames), mb))
+
+    elapsed = decode_all(frames, lambda body: json.loads(bytes(body).decode()))
+    print("{:<16s}: {:8.1f} MiB/s".format('decode+json', mb / elapsed))
+    for name in rpc.CODECS:
+        try:
+            codec = rpc.get_codec(name)
+        except ImportError:
+            print("{:<16s}: not installed".format(name))
+            continue
+        elapsed = decode_all(frames, codec.loads)
+        print("{:<16s}: {:8.1f} MiB/s".format(name, mb / elapsed))
+
+    session = rpc.MRPCSession(None, None, rpc.MRPCCredential.new_mak('0'))
+    payload = {'bodyId': 'tsn:0000000000000', 'titleKeyword': 'news', 'count': 25, 'levelOfDetail': 'medium'}
+    for name, encode in (('legacy headers', lambda i: legacy_encode(session, i, 'offerSearch', dict(payload))),
+                         ('cached headers', lambda i: session.encode_request(i, 'offerSearch', dict(payload)))):
+        t0 = time.perf_counter()
+        for i in range(args.requests):
+            encode(i)
+        elapsed = time.perf_counter() - t0
+        print("{:<16s}: {:8.2f} us/request".format(name, elapsed * 1e6 / args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Compares the legacy BytesIO response reader with MRPCFrameReader.
+
+Run from the project root:
+
+    python -m benchmarks.frame_reader [--capture FILE] [--size-mb N]
+
+FILE is a raw capture of MRPC/2 response frames as read off the socket.
+Without one, synthetic channelSearch responses are generated.
+"""
+
+import argparse
+import io
+import json
+import re
+import time
+
+from tivotalk.mind.rpc import MRPCFrameReader, MRPCSession
+
+
+class ReplaySocket(object):
+
+    def __init__(self, data, chunk_size=16384):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.chunk_size = chunk_size
+
+    def recv(self, buflen=1024):
+        n = min(buflen, self.chunk_size)
+        chunk = self.data[self.pos:self.pos + n].tobytes()
+        self.pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer, nbytes=0):
+        n = min(nbytes or len(buffer), self.chunk_size, len(self.data) - self.pos)
+        buffer[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class LegacyReader(object):
+
+    proto_pat = re.compile("^.*MRPC/2 (?P<h_size>\\d+) (?P<b_size>\\d+)\r\n")
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.copies = 0
+
+    def getvalue(self, buffer):
+        self.copies += 1
+        return buffer.getvalue()
+
+    def decode(self, value):
+        self.copies += 1
+        return value.decode()
+
+    def read_frame(self):
+        buffer = io.BytesIO()
+        buffer.write(self.socket.recv())
+        while b"\n" not in self.getvalue(buffer):
+            buffer.write(self.socket.recv())
+        buf_val = self.decode(self.getvalue(buffer))
+        m = self.proto_pat.search(buf_val)
+        h_size = int(m.groupdict()['h_size'])
+        b_size = int(m.groupdict()['b_size'])
+        h_start = m.span()[-1]
+        while buffer.tell() - h_start < h_size + b_size:
+            buffer.write(self.socket.recv())
+        buf_val = self.decode(self.getvalue(buffer))
+        headers = MRPCSession.parse_headers(buf_val[h_start:h_start + h_size])
+        return headers, buf_val[h_start + h_size:]
+
+
+def make_frame(rpc_id, body):
+    headers = "Type: response\r\nRpcId: {:d}\r\nContent-Type: application/json\r\n\r\n".format(rpc_id)
+    return "MRPC/2 {:d} {:d}\r\n".format(len(headers), len(body)).encode() + headers.encode() + body + b"\n"
+
+
+def synthetic_capture(size_mb, page_size=25):
+    channel = {"type": "channel", "channelNumber": "0", "name": "", "callSign": "",
+               "isHdtv": True, "isReceived": True, "sourceType": "cable", "stationId": "",
+               "logoIndex": 65536, "levelOfDetail": "medium", "affiliate": "Independent"}
+    frames = []
+    total = 0
+    rpc_id = 0
+    while total < size_mb * 2**20:
+        page = []
+        for i in range(page_size):
+            c = dict(channel)
+            n = rpc_id * page_size + i
+            c.update(channelNumber=str(n), name="CH{:04d}HD".format(n), callSign="CH{:04d}".format(n),
+                     stationId="tivo:st.{:d}".format(1000000 + n))
+            page.append(c)
+        frame = make_frame(rpc_id, json.dumps({"type": "channelList", "channel": page}).encode())
+        frames.append(frame)
+        total += len(frame)
+        rpc_id += 1
+    return frames
+
+
+def split_capture(data):
+    starts = [m.start() for m in MRPCFrameReader.preamble_pat.finditer(data)]
+    return [data[a:b] for a, b in zip(starts, starts[1:] + [len(data)])]
+
+
+def run(reader_cls, frames, chunk_size):
+    # One socket per frame mirrors the lock-step request/response pattern.
+    readers = [reader_cls(ReplaySocket(f, chunk_size)) for f in frames]
+    t0 = time.perf_counter()
+    for reader in readers:
+        reader.read_frame()
+    return time.perf_counter() - t0, sum(r.copies for r in readers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--capture', help='raw MRPC/2 response capture')
+    parser.add_argument('--size-mb', type=float, default=4.0, help='synthetic capture size')
+    parser.add_argument('--page-size', type=int, default=1000, help='channels per synthetic frame')
+    parser.add_argument('--chunk', type=int, default=16384, help='bytes returned per recv')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as cf:
+            frames = split_capture(cf.read())
+    else:
+        frames = synthetic_capture(args.size_mb, args.page_size)
+    mb = sum(len(f) for f in frames) / 2**20
+    print("{:d} frames, {:.2f} MiB, {:d} byte chunks".format(len(frames), mb, args.chunk))
+
+    for name, reader_cls in (('legacy', LegacyReader), ('frame reader', MRPCFrameReader)):
+        elapsed, copies = run(reader_cls, frames, args.chunk)
+        print("{:<13s}: {:8.1f} MiB/s  {:8.1f} copies/frame".format(name, mb / elapsed, copies / len(frames)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compares proxy channel lineup startup cost: full channel dicts versus Lineup.
+
+Run from the project root:
+
+    python -m benchmarks.lineup_load [--lineup channels.json] [--channels N]
+
+Reports load time and the Python heap retained by the loaded lineup
+(tracemalloc), which dominates the proxy's resident size at startup.
+"""
+
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from tivotalk.server.channels import Lineup
+
+
+def full_channel(n):
+    return {'type': 'channel', 'channelNumber': str(100 + n), 'name': 'CH{:04d}HD'.format(n),
+            'callSign': 'CH{:04d}'.format(n), 'stationId': 'tivo:st.{:d}'.format(n), 'isHdtv': n % 2 == 0,
+            'isReceived': n % 5 != 0, 'isBlocked': False, 'isDigital': True, 'isKidZone': False,
+            'sourceType': 'cable', 'logoIndex': 65536 + n, 'affiliate': 'Independent', 'levelOfDetail': 'medium',
+            'objectIdAndType': '{:d}'.format(1000000 + n), 'channelId': 'tivo:ch.{:d}'.format(n),
+            'partnerStationId': 'gn:{:d}'.format(n), 'descriptionLanguage': 'English', 'isEntitled': True}
+
+
+def load_dicts(path):
+    with open(path, 'rt') as cf:
+        channel_data = json.load(cf)
+    return ({c['channelNumber']: c for c in channel_data if c['isReceived']},
+            {c['name']: c for c in channel_data if c['isReceived']})
+
+
+def measure(load, path):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = load(path)
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return elapsed, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lineup', help='channels.json saved by the proxy')
+    parser.add_argument('--channels', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'channels.json')
+        if args.lineup:
+            with open(args.lineup, 'rt') as src, open(path, 'wt') as dst:
+                dst.write(src.read())
+        else:
+            with open(path, 'wt') as cf:
+                json.dump([full_channel(n) for n in range(args.channels)], cf)
+
+        rows = [('full dicts', load_dicts),
+                ('Lineup (no cache)', Lineup.load),
+                ('Lineup (cached)', Lineup.load)]
+        print("channels.json: {:.1f} KiB".format(os.path.getsize(path) / 1024))
+        for name, load in rows:
+            elapsed, retained = measure(load, path)
+            print("{:<18s}: {:7.2f} ms  {:8.1f} KiB retained".format(name, elapsed * 1000, retained / 1024))
+        print("projected cache: {:.1f} KiB".format(os.path.getsize(path + '.lineup') / 1024))
+
+
+if __name__ == '__main__':
+    main()
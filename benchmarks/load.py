@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Drives concurrent Mind clients against the local mock MRPC server.
+
+Starts a MockMindServer in-process and runs a mixed search/key workload
+from several client threads, each with its own authenticated session:
+
+    python -m benchmarks.load [--clients 8] [--requests 50] [--latency 0.02] [--plain]
+
+Reports p50/p99 latency per operation and overall throughput.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+import tivotalk.mind.api as api
+import tivotalk.mind.mock as mock
+import tivotalk.mind.rpc as rpc
+
+
+def op_channels(mind, rnd, fixtures):
+    return mind.channel_search()
+
+
+def op_offers(mind, rnd, fixtures):
+    f = api.SearchFilter()
+    f.by_title(rnd.choice(fixtures['offer'])['title'])
+    return mind.offer_search(filt=f, limit=50)
+
+
+def op_recordings(mind, rnd, fixtures):
+    return mind.recording_search()
+
+
+def op_content(mind, rnd, fixtures):
+    f = api.SearchFilter()
+    f.by_content_id(rnd.choice(fixtures['content'])['contentId'])
+    return mind.content_search(filt=f, limit=1)
+
+
+def op_key(mind, rnd, fixtures):
+    return mind.send_key('pause')
+
+
+OPERATIONS = [('channels', op_channels, 1),
+              ('offers', op_offers, 4),
+              ('recordings', op_recordings, 2),
+              ('content', op_content, 4),
+              ('key', op_key, 2)]
+
+
+def new_mind(args, port, cert_path):
+    credential = rpc.MRPCCredential.new_mak('0')
+    if cert_path is None:
+        session = rpc.MRPCSession(socket_maker=mock.PlainSocketMaker(), address='127.0.0.1',
+                                  credential=credential, port=port)
+    else:
+        session = rpc.MRPCSession.new_session(cert_path, None, '127.0.0.1', credential, port=port)
+    session.connect()
+    return api.Mind(session, parallel_pages=args.parallel_pages)
+
+
+def client(args, port, cert_path, fixtures, seed, samples, errors):
+    rnd = random.Random(seed)
+    names, ops, weights = zip(*OPERATIONS)
+    mind = new_mind(args, port, cert_path)
+    try:
+        for _ in range(args.requests):
+            n = rnd.choices(range(len(ops)), weights=weights)[0]
+            t0 = time.perf_counter()
+            try:
+                ops[n](mind, rnd, fixtures)
+            except (rpc.MRPCError, OSError) as e:
+                errors.append(e)
+                continue
+            samples[names[n]].append(time.perf_counter() - t0)
+    finally:
+        mind.session.close()
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    if not samples:
+        return
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print("{:<11s}: p50 {:7.1f} ms  p99 {:7.1f} ms  ({:d} ops)".format(
+        name, statistics.median(samples) * 1000, p99 * 1000, len(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', help='fixture JSON file; synthetic data if omitted')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='operations per client')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--parallel-pages', type=int, default=4)
+    parser.add_argument('--plain', action='store_true', help='use plain TCP instead of TLS')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures, 'rt') as f:
+            fixtures = json.load(f)
+    else:
+        fixtures = mock.synthetic_fixtures()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_path = None if args.plain else mock.make_certificate(tmp)
+        mind = mock.MockMind(fixtures, page_size=args.page_size)
+        server = mock.MockMindServer(mind, cert_path=cert_path, latency=args.latency, jitter=args.jitter)
+        server.start()
+        try:
+            samples = {name: [] for name, _, _ in OPERATIONS}
+            errors = []
+            threads = [threading.Thread(target=client,
+                                        args=(args, server.port, cert_path, fixtures, args.seed + n, samples, errors))
+                       for n in range(args.clients)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - t0
+        finally:
+            server.stop()
+
+    print("{:d} clients x {:d} ops, {} transport, {:.0f} ms server latency".format(
+        args.clients, args.requests, 'plain' if args.plain else 'TLS', args.latency * 1000))
+    for name, _, _ in OPERATIONS:
+        report(name, samples[name])
+    report('all', [s for v in samples.values() for s in v])
+    total = sum(len(v) for v in samples.values())
+    print("throughput : {:.1f} ops/s  ({:d} ops in {:.2f} s, {:d} errors)".format(
+        total / elapsed, total, elapsed, len(errors)))
+    print("server     : {}".format(', '.join('{}={:d}'.format(k, v) for k, v in sorted(mind.requests.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the TiVoProxy command pipeline.
+
+Commands are fed into Communicator.messages of a TiVoProxy whose PubNub
+client is replaced by an in-process fake, dispatched through do_cmd_*
+against the local mock MRPC server, and collected from publish:
+
+    python -m benchmarks.pipeline [--commands 200] [--concurrency 4] [--latency 0.02] [--output run.json]
+
+Latency is broken down per command into queue wait, pool checkout, MRPC
+round trips, JSON parse, fuzzy channel match, date handling (arrow and
+parse_date), publish and the remaining handler time.  Results are written
+as JSON; pass --compare with an earlier file to print p50 deltas.
+"""
+
+import argparse
+import collections
+import datetime
+import functools
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+import arrow
+import lambdaskill.utils as utils
+
+import tivotalk.mind.api as api
+import tivotalk.mind.mock as mock
+import tivotalk.mind.rpc as rpc
+import tivotalk.server.proxy as proxy
+from tivotalk.server.channels import ChannelIndex
+
+
+STAGES = ('queue', 'checkout', 'mrpc', 'parse', 'match', 'dates', 'publish', 'other')
+
+
+class StageClock(object):
+    """Accumulates exclusive time per stage for the command on this thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self, record):
+        self.local.record = record
+        self.local.stack = []
+
+    def end(self):
+        record = self.local.record
+        self.local.record = None
+        self.local.stack = None
+        return record
+
+    @property
+    def record(self):
+        return getattr(self.local, 'record', None)
+
+    def wrap(self, stage, fn):
+        clock = self
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            stack = getattr(clock.local, 'stack', None)
+            if stack is None:
+                return fn(*args, **kwargs)
+            stack.append(0.0)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                clock.local.record['stages'][stage] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+
+def instrument(clock):
+    rpc.MRPCSession.wait = clock.wrap('mrpc', rpc.MRPCSession.wait)
+    api.MindManager.checkout = clock.wrap('checkout', api.MindManager.checkout)
+    get_codec = rpc.get_codec
+
+    def timed_codec(name=None):
+        codec = get_codec(name)
+        codec.loads = clock.wrap('parse', codec.loads)
+        return codec
+    rpc.get_codec = timed_codec
+    ChannelIndex.match = clock.wrap('match', ChannelIndex.match)
+    arrow.get = clock.wrap('dates', arrow.get)
+    utils.parse_date = clock.wrap('dates', utils.parse_date)
+
+
+class FakeCommunicator(object):
+    """Stands in for the PubNub Communicator; responses go to the bench."""
+
+    bench = None
+
+    def __init__(self, pub_key=None, sub_key=None, publish_channel="C_QUERY", subscribe_channel="C_RESP",
+                 client_id=None, debug=False, transport=None):
+        self.messages = queue.Queue()
+        self.connected = threading.Event()
+
+    def swap_channels(self):
+        pass
+
+    def connect(self):
+        self.connected.set()
+
+    def publish(self, message):
+        FakeCommunicator.bench.published(message)
+
+
+class PipelineBench(object):
+
+    def __init__(self, clock, concurrency):
+        self.clock = clock
+        self.slots = threading.Semaphore(concurrency)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.records = []
+        self.done = threading.Condition(self.lock)
+        self.proxy = None
+
+    def attach(self, tivo_proxy):
+        self.proxy = tivo_proxy
+        handle = tivo_proxy.dispatcher.handler
+        tivo_proxy.dispatcher.handler = lambda msg: self.handle(handle, msg)
+
+    def feed(self, msg):
+        self.slots.acquire()
+        with self.lock:
+            self.pending[id(msg)] = {'cmd': msg['cmd'], 'fed': time.perf_counter(),
+                                     'stages': collections.Counter()}
+        self.proxy.com.messages.put(types.SimpleNamespace(message=msg))
+
+    def handle(self, handle, msg):
+        with self.lock:
+            record = self.pending.pop(id(msg))
+        record['started'] = time.perf_counter()
+        self.clock.begin(record)
+        return handle(msg)
+
+    def published(self, message):
+        record = self.clock.record
+        if record is None:
+            return
+        t0 = time.perf_counter()
+        # PubNub serialises the message before sending it.
+        json.dumps(message)
+        now = time.perf_counter()
+        stages = record['stages']
+        stages['publish'] += now - t0
+        record['chunks'] = record.get('chunks', 0) + 1
+        if 'seq' in message and not message.get('last'):
+            # Chunked results keep streaming; the command ends with the last chunk.
+            return
+        stages['queue'] = record['started'] - record['fed']
+        stages['other'] = now - record['started'] - sum(v for k, v in stages.items() if k != 'queue')
+        record['total'] = now - record['fed']
+        record['status'] = message.get('status')
+        self.clock.end()
+        with self.lock:
+            self.records.append(record)
+            self.done.notify_all()
+        self.slots.release()
+
+    def wait(self, count, timeout=None):
+        with self.lock:
+            return self.done.wait_for(lambda: len(self.records) >= count, timeout)
+
+
+def workload(fixtures, count, seed):
+    rnd = random.Random(seed)
+    titles = sorted({o['title'] for o in fixtures['offer']})
+    channels = [c for c in fixtures['channel'] if c['isHdtv']]
+    content_ids = [r['contentId'] for r in fixtures['recording']]
+    today = datetime.date.today().isoformat()
+    messages = []
+    for _ in range(count):
+        kind = rnd.choices(('WHENIS', 'WHATSON', 'TELLABOUT', 'PAUSE'), weights=(4, 2, 2, 2))[0]
+        if kind == 'WHENIS':
+            channel = rnd.choice(channels) if rnd.random() < 0.5 else None
+            msg = {'title': rnd.choice(titles).lower(), 'rec_time': 'PRESENT_REF',
+                   'c_name': channel['name'].lower() if channel else None, 'c_num': None}
+        elif kind == 'WHATSON':
+            msg = {'rec_time': today}
+        elif kind == 'TELLABOUT':
+            msg = {'content_ids': rnd.sample(content_ids, min(3, len(content_ids)))}
+        else:
+            msg = {}
+        msg['cmd'] = kind
+        messages.append(msg)
+    return messages
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return {'mean': 1000 * sum(samples) / len(samples),
+            'p50': 1000 * samples[len(samples) // 2],
+            'p99': 1000 * samples[min(len(samples) - 1, int(len(samples) * 0.99))]}
+
+
+def results(records):
+    by_cmd = collections.defaultdict(list)
+    for r in records:
+        by_cmd[r['cmd']].append(r)
+    commands = {}
+    for cmd, rs in sorted(by_cmd.items()):
+        commands[cmd] = {'count': len(rs),
+                         'errors': sum(1 for r in rs if r['status'] != 'SUCCESS'),
+                         'chunks': sum(r['chunks'] for r in rs) / len(rs),
+                         'total': summarize([r['total'] for r in rs]),
+                         'stages': {s: summarize([r['stages'][s] for r in rs]) for s in STAGES}}
+    return commands
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(commands):
+    print("{:<10s} {:>5s} {:>9s} {:>9s}  ".format('command', 'n', 'p50 ms', 'p99 ms') +
+          ' '.join('{:>8s}'.format(s) for s in STAGES))
+    for cmd, r in commands.items():
+        print("{:<10s} {:5d} {:9.2f} {:9.2f}  ".format(cmd, r['count'], r['total']['p50'], r['total']['p99']) +
+              ' '.join('{:8.2f}'.format(r['stages'][s]['mean']) for s in STAGES))
+    print("(stage columns are mean ms per command)")
+
+
+def compare(commands, path):
+    with open(path, 'rt') as f:
+        before = json.load(f)
+    print("p50 change versus {} ({}):".format(path, before.get('revision')))
+    for cmd, r in commands.items():
+        old = before['commands'].get(cmd)
+        if old is None:
+            continue
+        deltas = ['total {:+.2f}'.format(r['total']['p50'] - old['total']['p50'])]
+        deltas += ['{} {:+.2f}'.format(s, r['stages'][s]['p50'] - old['stages'][s]['p50'])
+                   for s in STAGES if old['stages'].get(s)]
+        print("{:<10s} {}".format(cmd, ', '.join(deltas)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', help='fixture JSON file; synthetic data if omitted')
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4, help='commands in flight at once')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--parallel-pages', type=int, default=4)
+    parser.add_argument('--cache-size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures, 'rt') as f:
+            fixtures = json.load(f)
+    else:
+        fixtures = mock.synthetic_fixtures()
+
+    clock = StageClock()
+    bench = PipelineBench(clock, args.concurrency)
+    FakeCommunicator.bench = bench
+    proxy.Communicator = FakeCommunicator
+    instrument(clock)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = mock.MockMindServer(mock.MockMind(fixtures, page_size=args.page_size),
+                                     cert_path=mock.make_certificate(tmp), latency=args.latency, jitter=args.jitter)
+        server.start()
+        # TiVoProxy caches channels.json in the working directory.
+        os.chdir(tmp)
+        try:
+            config = {'TT_CERT_PATH': os.path.join(tmp, 'mock.pem'), 'TT_CERT_PWD': None,
+                      'TT_TIVO_ADDR': '127.0.0.1', 'TT_TIVO_PORT': str(server.port), 'TT_TIVO_MAK': '0',
+                      'TT_TRANSPORT': 'local', 'TT_TIVO_TZ': 'UTC',
+                      'TT_POOL_SIZE': args.pool_size, 'TT_PARALLEL_PAGES': args.parallel_pages,
+                      'TT_CACHE_SIZE': args.cache_size, 'TT_WORKERS': args.workers,
+                      'TT_MAX_QUEUE': args.commands + 1}
+            tivo_proxy = proxy.TiVoProxy(config)
+            bench.attach(tivo_proxy)
+            threading.Thread(target=tivo_proxy.run, name='TiVoProxy', daemon=True).start()
+            messages = workload(fixtures, args.commands, args.seed)
+            t0 = time.perf_counter()
+            for msg in messages:
+                bench.feed(msg)
+            if not bench.wait(len(messages), timeout=600):
+                raise TimeoutError('Only {:d} of {:d} commands completed.'.format(len(bench.records), len(messages)))
+            elapsed = time.perf_counter() - t0
+        finally:
+            os.chdir(cwd)
+            server.stop()
+
+    commands = results(bench.records)
+    output = {'revision': revision(),
+              'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+              'python': platform.python_version(),
+              'args': vars(args),
+              'elapsed': elapsed,
+              'throughput': len(bench.records) / elapsed,
+              'dispatcher': tivo_proxy.dispatcher.stats(),
+              'cache': tivo_proxy.manager.cache.stats() if tivo_proxy.manager.cache is not None else None,
+              'coalesced': tivo_proxy.flights.stats(),
+              'commands': commands}
+    print("{:d} commands in {:.2f} s ({:.1f}/s), concurrency {:d}, {:.0f} ms server latency".format(
+        len(bench.records), elapsed, output['throughput'], args.concurrency, args.latency * 1000))
+    report(commands)
+    if args.compare:
+        compare(commands, args.compare)
+    if args.output:
+        with open(args.output, 'wt') as out:
+            json.dump(output, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Measures bytes on the wire and JSON parse time per proxy command, with and
+without the command's projection preset.
+
+Run from the project root against the TiVo named in the config file:
+
+    python -m benchmarks.projection [--config tivotalk.conf] [--title TITLE]
+"""
+
+import argparse
+import configparser
+import datetime
+import time
+
+import tivotalk.mind.api as api
+import tivotalk.mind.rpc as rpc
+from tivotalk.server.proxy import PROJECTIONS
+
+
+class TimedSession(rpc.MRPCSession):
+
+    parse_time = 0.0
+
+    def _read_response(self):
+        headers, body = self.reader.read_frame()
+        t0 = time.perf_counter()
+        body = self.codec.loads(body)
+        self.parse_time += time.perf_counter() - t0
+        return headers, body
+
+
+def whenis(mind, projection, title):
+    f = api.SearchFilter()
+    f.by_title(title)
+    now = datetime.datetime.utcnow()
+    f.by_start_time(min_utc_time=now, max_utc_time=now + datetime.timedelta(days=1))
+    if projection:
+        f.set_projection(projection)
+    return mind.offer_search(filt=f, limit=10)
+
+
+def whatson(mind, projection, arg):
+    f = api.SearchFilter()
+    if projection:
+        f.set_projection(projection)
+    return mind.recording_search(filt=f)
+
+
+def tellabout(mind, projection, content_ids):
+    return mind.content_lookup_many(content_ids, projection)
+
+
+def measure(session, command, projection, arg):
+    mind = api.Mind(session)
+    bytes_read = session.reader.bytes_read
+    session.parse_time = 0.0
+    command(mind, projection, arg)
+    return session.reader.bytes_read - bytes_read, session.parse_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='tivotalk.conf')
+    parser.add_argument('--title', default='news')
+    args = parser.parse_args()
+
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    config = cfg['General']
+    session = TimedSession.new_local_session(cert_path=config['TT_CERT_PATH'],
+                                             cert_password=config['TT_CERT_PWD'],
+                                             address=config['TT_TIVO_ADDR'],
+                                             mak=config['TT_TIVO_MAK'],
+                                             port=int(config.get('TT_TIVO_PORT', 1413)))
+    session.connect()
+    try:
+        content_ids = [r['contentId'] for r in api.Mind(session).recording_search(limit=5)]
+        commands = (('WHENIS', whenis, args.title), ('WHATSON', whatson, None), ('TELLABOUT', tellabout, content_ids))
+        for name, command, arg in commands:
+            for label, projection in (('medium', None), ('preset', PROJECTIONS[name])):
+                received, parse_time = measure(session, command, projection, arg)
+                print("{:<10s}{:<7s}: {:10d} bytes  {:8.2f} ms parse".format(name, label, received, parse_time * 1000))
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Measures skill-to-proxy round trips over PubNub, cold versus warm.
+
+Run from the project root with the PubNub keys from the config file:
+
+    python -m benchmarks.skill_roundtrip [--config tivotalk.conf] [--runs N]
+
+An in-process responder stands in for TiVoProxy and answers every PAUSE.
+A cold call builds a new Communicator, as every Lambda invocation used to,
+so it pays for the subscribe handshake.  A warm call reuses one connected
+Communicator through ensure_connected, as warm invocations of
+alexa/talk.py now do.
+"""
+
+import argparse
+import configparser
+import threading
+import time
+
+from tivotalk.server.pubcom import Communicator, RoundTripStats
+
+
+def responder(config):
+    com = Communicator(config['TT_PUBKEY'], config['TT_SUBKEY'], client_id=config['TT_CLIENT_ID'] + '-proxy')
+    com.swap_channels()
+    com.connect()
+    if not com.connected.wait(timeout=10.0):
+        raise ConnectionError('Responder failed to connect to PubNub.')
+
+    def answer():
+        while True:
+            msg = com.messages.get().message
+            com.messages.task_done()
+            com.publish(message={'cmd': msg['cmd'], 'status': 'SUCCESS', 'id': msg['id']})
+    threading.Thread(target=answer, name='Responder', daemon=True).start()
+    return com
+
+
+def round_trip(com, stats):
+    t0 = time.perf_counter()
+    connected, fast = com.ensure_connected(timeout=10.0)
+    if not connected:
+        raise ConnectionError('Failed to connect to PubNub.')
+    with com.request({'cmd': 'PAUSE'}) as call:
+        call.get(timeout=10.0)
+    stats.record(time.perf_counter() - t0, fast)
+
+
+def report(name, stats):
+    s = stats.summary()
+    print("{:<5s}: p50 {:7.1f} ms  p99 {:7.1f} ms  ({:d} runs, {:d} fast path)".format(
+        name, s['p50'] * 1000, s['p99'] * 1000, s['count'], s['fast']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='tivotalk.conf')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    config = cfg['General']
+
+    proxy = responder(config)
+    try:
+        cold = RoundTripStats()
+        for _ in range(args.runs):
+            com = Communicator(config['TT_PUBKEY'], config['TT_SUBKEY'], client_id=config['TT_CLIENT_ID'])
+            round_trip(com, cold)
+            com.disconnect()
+
+        warm = RoundTripStats()
+        com = Communicator(config['TT_PUBKEY'], config['TT_SUBKEY'], client_id=config['TT_CLIENT_ID'])
+        for _ in range(args.runs + 1):
+            round_trip(com, warm)
+        # The first warm call made the connection; report steady state.
+        warm.samples.popleft()
+        warm.slow -= 1
+        com.disconnect()
+    finally:
+        proxy.disconnect()
+
+    report('cold', cold)
+    report('warm', warm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compares skill-to-proxy round-trip latency across message transports.
+
+Run from the project root:
+
+    python -m benchmarks.transport [--runs N] [--config tivotalk.conf]
+
+Each backend gets an in-process responder standing in for TiVoProxy that
+answers every PAUSE, and a client Communicator that sends warm requests
+through Communicator.request, as alexa/talk.py does.  The Unix-socket and
+TCP backends always run; PubNub runs when the config file has its keys.
+"""
+
+import argparse
+import configparser
+import os
+import tempfile
+import threading
+import time
+
+from tivotalk.server.pubcom import Communicator, RoundTripStats
+from tivotalk.server.transport import LocalTransport, PubNubTransport
+
+
+def responder(transport):
+    com = Communicator(transport=transport)
+    com.swap_channels()
+    com.connect()
+    if not com.connected.wait(timeout=10.0):
+        raise ConnectionError('Responder failed to connect.')
+
+    def answer():
+        while com.opened:
+            try:
+                msg = com.wait_for_message(timeout=0.5).message
+            except Exception:
+                continue
+            com.publish(message={'cmd': msg['cmd'], 'status': 'SUCCESS', 'id': msg['id']})
+    threading.Thread(target=answer, name='Responder', daemon=True).start()
+    return com
+
+
+def measure(server, make_client, runs):
+    # The client is built once the responder is listening (a TCP server may be on an ephemeral port).
+    proxy = responder(server)
+    com = Communicator(transport=make_client())
+    stats = RoundTripStats(size=runs)
+    try:
+        connected, _ = com.ensure_connected(timeout=10.0)
+        if not connected:
+            raise ConnectionError('Client failed to connect.')
+        # The first call may still race the subscribe; keep it out of the numbers.
+        with com.request({'cmd': 'PAUSE'}) as call:
+            call.get(timeout=10.0)
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            connected, fast = com.ensure_connected(timeout=10.0)
+            with com.request({'cmd': 'PAUSE'}) as call:
+                call.get(timeout=10.0)
+            stats.record(time.perf_counter() - t0, fast)
+    finally:
+        com.disconnect()
+        proxy.disconnect()
+    return stats
+
+
+def report(name, stats):
+    s = stats.summary()
+    print("{:<7s}: p50 {:8.3f} ms  p99 {:8.3f} ms  ({:d} runs)".format(
+        name, s['p50'] * 1000, s['p99'] * 1000, s['count']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='tivotalk.conf')
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--pubnub-runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        address = 'unix:' + os.path.join(tmp, 'bench.sock')
+        report('unix', measure(LocalTransport(address, listen=True), lambda: LocalTransport(address), args.runs))
+
+    server = LocalTransport('127.0.0.1:0', listen=True)
+    report('tcp', measure(server, lambda: LocalTransport('127.0.0.1:{:d}'.format(server.port)), args.runs))
+
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    if cfg.has_section('General') and cfg['General'].get('TT_PUBKEY'):
+        config = cfg['General']
+        server = PubNubTransport(config['TT_PUBKEY'], config['TT_SUBKEY'], client_id=config['TT_CLIENT_ID'] + '-proxy')
+        report('pubnub', measure(server,
+                                 lambda: PubNubTransport(config['TT_PUBKEY'], config['TT_SUBKEY'],
+                                                         client_id=config['TT_CLIENT_ID']),
+                                 args.pubnub_runs))
+    else:
+        print('pubnub : skipped (no keys in {})'.format(args.config))
+
+
+if __name__ == '__main__':
+    main()
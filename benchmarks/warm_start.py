@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Measures cold-start versus warm-start latency of TiVoProxy.do_cmd_pause.
+
+Run from the project root against the TiVo named in the config file:
+
+    python -m benchmarks.warm_start [--config tivotalk.conf] [--runs N]
+
+A cold start builds a fresh MindManager, so each command pays for the TCP
+connect, TLS handshake and bodyAuthenticate.  A warm start uses a manager
+with keep_warm=1 that was pre-warmed in the background.
+"""
+
+import argparse
+import configparser
+import statistics
+import time
+import types
+
+import tivotalk.mind.api as api
+import tivotalk.mind.rpc as rpc
+from tivotalk.server.proxy import TiVoProxy
+
+
+def new_manager(config, keep_warm=0):
+    return api.MindManager(config['TT_CERT_PATH'],
+                           config['TT_CERT_PWD'],
+                           config['TT_TIVO_ADDR'],
+                           rpc.MRPCCredential.new_mak(config['TT_TIVO_MAK']),
+                           port=int(config.get('TT_TIVO_PORT', 1413)),
+                           size=1,
+                           keep_warm=keep_warm)
+
+
+def time_pause(manager):
+    proxy = types.SimpleNamespace(manager=manager)
+    t0 = time.perf_counter()
+    TiVoProxy.do_cmd_pause(proxy, {'cmd': 'PAUSE'})
+    return time.perf_counter() - t0
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print("{:<5s}: p50 {:7.1f} ms  p99 {:7.1f} ms  ({:d} runs)".format(
+        name, statistics.median(samples) * 1000, p99 * 1000, len(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='tivotalk.conf')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    config = cfg['General']
+
+    cold = []
+    for _ in range(args.runs):
+        manager = new_manager(config)
+        cold.append(time_pause(manager))
+        manager.disconnect()
+
+    manager = new_manager(config, keep_warm=1)
+    manager.prewarm(wait=True)
+    warm = [time_pause(manager) for _ in range(args.runs)]
+    manager.disconnect()
+
+    report('cold', cold)
+    report('warm', warm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compares plain JSON list results with the compact wire format.
+
+Run from the project root:
+
+    python -m benchmarks.wire [--offers 10] [--recordings 50] [--details 10] [--loops 2000]
+
+Builds WHENIS, WHATSON and TELLABOUT results from the mock fixtures and
+reports, for each: the bytes published (all chunks, as PubNub would see
+them), the bytes alexa/talk.py keeps in session attributes, and the time
+to encode and decode one result.
+"""
+
+import argparse
+import json
+import time
+
+import tivotalk.mind.mock as mock
+import tivotalk.server.wire as wire
+from tivotalk.server.chunks import ChunkedResult
+from tivotalk.server.proxy import TiVoProxy
+
+
+def results(fixtures, args):
+    fields = ["title", "subtitle", "seasonNumber", "episodeNum", "description"]
+    offers = [TiVoProxy.offer_summary(o) for o in fixtures['offer'][:args.offers]]
+    recordings = [[r['title'], r['contentId']] for r in fixtures['recording'][:args.recordings]]
+    details = [{k: c[k] for k in fields} for c in fixtures['content'][:args.details]]
+    return [('WHENIS', 'offers', offers, True), ('WHATSON', 'recordings', recordings, True),
+            ('TELLABOUT', 'details', details, False)]
+
+
+def published(cmd, list_key, items, packed, compress_bytes):
+    r = ChunkedResult({'cmd': cmd, 'status': 'SUCCESS'}, list_key, items,
+                      packed=packed, compress_bytes=compress_bytes)
+    return sum(len(json.dumps(m)) for m in r.messages('0' * 32))
+
+
+def per_call(loops, fn):
+    t0 = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    return (time.perf_counter() - t0) / loops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--offers', type=int, default=10)
+    parser.add_argument('--recordings', type=int, default=50)
+    parser.add_argument('--details', type=int, default=10)
+    parser.add_argument('--loops', type=int, default=2000)
+    parser.add_argument('--compress-bytes', type=int, default=wire.COMPRESS_BYTES)
+    args = parser.parse_args()
+
+    fixtures = mock.synthetic_fixtures(offers=max(args.offers, args.details, args.recordings),
+                                       recordings=args.recordings)
+    print("{:<20s} {:>5s} {:>15s} {:>15s} {:>11s} {:>11s}".format(
+        'result', 'items', 'publish B', 'session B', 'encode us', 'decode us'))
+    for cmd, list_key, items, stored in results(fixtures, args):
+        for name, compress_bytes in (('json', None), ('packed', None), ('packed+z', args.compress_bytes)):
+            if name == 'json':
+                size = published(cmd, list_key, items, False, None)
+                session = len(json.dumps(items)) if stored else 0
+                encode = per_call(args.loops, lambda: json.dumps(items))
+                data = json.dumps(items)
+                decode = per_call(args.loops, lambda: json.loads(data))
+            else:
+                size = published(cmd, list_key, items, True, compress_bytes)
+                value = wire.pack_list(list_key, items, compress_bytes)
+                session = len(json.dumps(value)) if stored else 0
+                encode = per_call(args.loops, lambda: json.dumps(wire.pack_list(list_key, items, compress_bytes)))
+                data = json.dumps(value)
+                decode = per_call(args.loops, lambda: wire.unpack_list(json.loads(data)))
+                if wire.unpack_list(value) != json.loads(json.dumps(items)):
+                    raise AssertionError('{} did not round-trip {}.'.format(name, list_key))
+            print("{:<20s} {:5d} {:>15s} {:>15s} {:11.1f} {:11.1f}".format(
+                '{} {}'.format(cmd, name), len(items), '{:d}'.format(size),
+                '{:d}'.format(session) if stored else '-', encode * 1e6, decode * 1e6))
+
+
+if __name__ == '__main__':
+    main()
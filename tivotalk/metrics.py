@@ -0,0 +1,193 @@
+import bisect
+import http.server
+import json
+import threading
+
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+
+# name: (kind, help, buckets)
+METRICS = {
+    'mrpc_rtt_seconds': ('histogram', 'MRPC request round-trip time.', TIME_BUCKETS),
+    'mrpc_connect_seconds': ('histogram', 'TCP connect and TLS handshake time.', TIME_BUCKETS),
+    'mrpc_auth_seconds': ('histogram', 'bodyAuthenticate round-trip time.', TIME_BUCKETS),
+    'mrpc_connects_total': ('counter', 'MRPC sessions opened.', None),
+    'mrpc_bytes_sent_total': ('counter', 'MRPC request bytes written.', None),
+    'mrpc_bytes_received_total': ('counter', 'MRPC response bytes read.', None),
+    'mind_pages': ('histogram', 'Page requests sent per search.', COUNT_BUCKETS),
+    'mind_reconnects_total': ('counter', 'Pooled sessions dropped and replaced.', None),
+    'mind_cache_lookups_total': ('counter', 'QueryCache lookups.', None),
+    'proxy_queue_wait_seconds': ('histogram', 'Time a command waited for a dispatcher worker.', TIME_BUCKETS),
+    'proxy_queue_depth': ('gauge', 'Commands queued or deferred, waiting for a dispatcher worker.', None),
+    'proxy_command_seconds': ('histogram', 'TiVoProxy command handler latency.', TIME_BUCKETS),
+    'proxy_coalesced_total': ('counter', 'Searches run (leader) or shared with an identical in-flight one (hit).',
+                              None),
+}
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation.
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return self.max
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield bound, total
+
+    def as_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'p50': self.quantile(0.5) if self.count else 0.0,
+                'p99': self.quantile(0.99) if self.count else 0.0,
+                'buckets': {repr(b): n for b, n in self.cumulative()}}
+
+
+class Registry(object):
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram(METRICS.get(name, (None, None, TIME_BUCKETS))[2])
+            h.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        out = {}
+        with self.lock:
+            for (name, labels), value in sorted(list(self.counters.items()) + list(self.gauges.items())):
+                out.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), h in sorted(self.histograms.items()):
+                out.setdefault(name, []).append(dict(h.as_dict(), labels=dict(labels)))
+        return out
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in pairs) + '}'
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+        with self.lock:
+            entries = sorted(list(self.counters.items()) + list(self.gauges.items()) + list(self.histograms.items()),
+                             key=lambda e: e[0])
+            for (name, labels), value in entries:
+                if name not in typed:
+                    kind, text, _ = METRICS.get(name, ('untyped', '', None))
+                    if text:
+                        lines.append('# HELP {} {}'.format(name, text))
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    typed.add(name)
+                if isinstance(value, Histogram):
+                    for bound, total in value.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}_bucket{} {:d}'.format(name, self.format_labels(labels, [('le', le)]), total))
+                    lines.append('{}_sum{} {!r}'.format(name, self.format_labels(labels), value.sum))
+                    lines.append('{}_count{} {:d}'.format(name, self.format_labels(labels), value.count))
+                else:
+                    lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = registry.to_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = registry.to_json(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+from tivotalk.metrics import registry as metrics
+import tivotalk.mind.api as api
+import tivotalk.mind.rpc as rpc
+
+
+class AsyncMRPCSession(rpc.MRPCSession):
+
+    def __init__(self, socket_maker, address, credential, port=1413, debug=False, codec=None):
+        rpc.MRPCSession.__init__(self, socket_maker, address, credential, port=port, debug=debug, codec=codec)
+        self.stream_reader = None
+        self.writer = None
+        self.read_task = None
+
+    async def connect(self):
+        t0 = time.perf_counter()
+        self.stream_reader, self.writer = await asyncio.open_connection(self.address, self.port, ssl=self.sm.ctx)
+        self.read_task = asyncio.ensure_future(self._read_loop())
+        t1 = time.perf_counter()
+        if metrics.enabled:
+            metrics.inc('mrpc_connects_total')
+            metrics.observe('mrpc_connect_seconds', t1 - t0)
+        h, b = await self.request("bodyAuthenticate", self.credential.payload())
+        if metrics.enabled:
+            metrics.observe('mrpc_auth_seconds', time.perf_counter() - t1)
+        try:
+            self.check_auth(b)
+        except rpc.MRPCError:
+            await self.close()
+            raise
+        if self.credential.cred_type == "WEB_CREDENTIAL":
+            self.body_id = self.web_body_id(b)
+        elif not self.body_id:
+            h, r = await self.request("bodyConfigSearch", {"bodyId": "-"})
+            self.body_id = self.config_body_id(r)
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.writer = None
+            self.stream_reader = None
+        self._fail_in_flight(rpc.MRPCError("Session closed with request in flight."))
+        self.sent.clear()
+
+    def _fail_in_flight(self, exc):
+        for future in self.in_flight.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.in_flight.clear()
+
+    async def read_frame(self):
+        line = await self.stream_reader.readuntil(b"\r\n")
+        m = rpc.MRPCFrameReader.preamble_pat.search(line)
+        if m is None:
+            raise rpc.MRPCError("Malformed MRPC preamble.")
+        h_size = int(m.group('h_size'))
+        b_size = int(m.group('b_size'))
+        data = await self.stream_reader.readexactly(h_size + b_size)
+        self.reader.frame_size = h_size + b_size
+        if self.debug:
+            print("RPC Response (H Size: {:d}, B Size: {:d})".format(h_size, b_size))
+        return self.parse_headers(data[:h_size].decode('ascii')), self.codec.loads(memoryview(data)[h_size:])
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._dispatch(*await self.read_frame())
+        except Exception as e:
+            # Covers SSL errors, undecodable bodies and oversized lines as well as a closed connection;
+            # nothing else would wake the waiters.
+            self._fail_in_flight(rpc.MRPCError("Connection lost: {!r}".format(e)))
+
+    def send_request(self, req_type, payload_json, multiple_responses=False):
+        rpc_id = self.next_rpc_id()
+        data = self.encode_request(rpc_id, req_type, payload_json, multiple_responses)
+        self.writer.write(data)
+        if metrics.enabled:
+            metrics.inc('mrpc_bytes_sent_total', len(data), request_type=req_type)
+        return rpc_id
+
+    def submit(self, req_type, payload_json):
+        if self.read_task is None or self.read_task.done():
+            raise rpc.MRPCError("Session is not reading responses.")
+        future = asyncio.get_event_loop().create_future()
+        rpc_id = self.send_request(req_type, payload_json)
+        self.in_flight[rpc_id] = future
+        self._track(rpc_id, req_type)
+        return future
+
+    def get_response(self):
+        raise NotImplementedError("Responses are routed by RpcId; use request() or submit().")
+
+    async def wait(self, future):
+        await self.writer.drain()
+        return await future
+
+    async def wait_all(self, futures):
+        await self.writer.drain()
+        return await asyncio.gather(*futures)
+
+    async def request(self, req_type, payload_json):
+        return await self.wait(self.submit(req_type, payload_json))
+
+
+class AsyncMind(api.Mind):
+
+    async def _get_paged_responses(self, req_type, payloads, target_array, page_size=None, limit=None):
+        results = [[] for _ in payloads]
+        streams = [{} for _ in payloads]
+        sent = [0] * len(payloads)
+        active = list(range(len(payloads)))
+        window = 1
+        while active:
+            batches = [(i, self._submit_pages(req_type, payloads[i], len(results[i]),
+                                              self.page_size_for(req_type, page_size, streams[i]), limit, window))
+                       for i in active]
+            pending = []
+            for i, pages in batches:
+                sent[i] += len(pages)
+                responses = await self.session.wait_all([f for f, _ in pages])
+                if self._collect_pages(streams[i], list(zip(responses, [c for _, c in pages])), results[i],
+                                       target_array, limit):
+                    pending.append(i)
+            active = pending
+            window = max(self.parallel_pages, 1)
+        self._observe_pages(req_type, sent)
+        return results
+
+    async def _get_paged_response(self, req_type, payload, target_array, page_size=None, limit=None):
+        return [item async for item in self._iter_paged_response(req_type, payload, target_array, page_size, limit)]
+
+    async def _iter_paged_response(self, req_type, payload, target_array, page_size=None, limit=None):
+        if self.cache is None or not self.cache.cacheable(req_type):
+            async for item in self._iter_pages(req_type, payload, target_array, page_size, limit):
+                yield item
+            return
+        key = self.cache.key(req_type, payload, limit)
+        cached = self.cache.get(key)
+        if cached is None:
+            first_rpc_id = self.session.rpc_id
+            cached = []
+            async for item in self._iter_pages(req_type, payload, target_array, page_size, limit):
+                cached.append(item)
+                yield item
+            self.cache.put(key, cached, self.session.rpc_id - first_rpc_id)
+            return
+        for item in cached:
+            yield item
+
+    async def _iter_pages(self, req_type, payload, target_array, page_size=None, limit=None):
+        offset = 0
+        window = 1
+        sent = 0
+        stream = {}
+        try:
+            while True:
+                pages = self._submit_pages(req_type, payload, offset,
+                                           self.page_size_for(req_type, page_size, stream), limit, window)
+                if not pages:
+                    return
+                sent += len(pages)
+                for future, count in pages:
+                    h, b = await self.session.wait(future)
+                    items = self._page_items(b, target_array, offset, limit)
+                    offset += len(items)
+                    for item in items:
+                        yield item
+                    state = self._page_state(stream, b, items, count, offset, limit)
+                    if state == api.Mind.LAST_PAGE:
+                        return
+                    if state == api.Mind.SHORT_PAGE:
+                        break
+                window = max(self.parallel_pages, 1)
+        finally:
+            if metrics.enabled:
+                metrics.observe('mind_pages', sent, request_type=req_type)
+
+    async def content_lookup_many(self, ids, paths=None):
+        payload = self._lookup_payload(paths)
+        found, missing = self._lookup_cached(payload, ids)
+        while missing and self.multi_id_lookup:
+            futures = self._submit_lookups(payload, missing, multi=True)
+            retry = self._collect_lookups(payload, missing, await self.session.wait_all(futures), found, multi=True)
+            if len(retry) == len(missing):
+                break
+            missing = retry
+        if missing:
+            futures = self._submit_lookups(payload, missing, multi=False)
+            self._collect_lookups(payload, missing, await self.session.wait_all(futures), found, multi=False)
+        return [found.get(id) for id in ids]
+
+    async def send_key(self, key):
+        h, b = await self.session.request('keyEventSend', {'event': key})
+        return b
+
+    @staticmethod
+    async def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
+        mrpc = AsyncMRPCSession.new_session(cert_path=cert_path,
+                                            cert_password=cert_password,
+                                            address=address,
+                                            credential=credential,
+                                            port=port,
+                                            debug=debug)
+        await mrpc.connect()
+        return AsyncMind(session=mrpc)
+
+    @staticmethod
+    async def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+        mrpc = AsyncMRPCSession.new_local_session(cert_path=cert_path,
+                                                  cert_password=cert_password,
+                                                  address=address,
+                                                  mak=mak,
+                                                  port=port,
+                                                  debug=debug)
+        await mrpc.connect()
+        return AsyncMind(session=mrpc)
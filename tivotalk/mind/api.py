@@ -1,12 +1,18 @@
+import collections
 import copy
 import contextlib
 import threading
+import time
 
+from tivotalk.metrics import registry as metrics
 import tivotalk.mind.rpc as rpc
 
 
 class SearchFilter(object):
 
+    # Nested fields whose record type differs from the field name.
+    FIELD_TYPES = {}
+
     def __init__(self):
         self.dict = {}
 
@@ -83,6 +89,22 @@ class SearchFilter(object):
         else:
             self.dict['responseTemplate'] = template_list[:]
 
+    @staticmethod
+    def projection_templates(paths):
+        fields = {}
+        for path in paths:
+            parts = path.split('.')
+            type_name = parts[0]
+            for field in parts[1:]:
+                names = fields.setdefault(type_name, [])
+                if field not in names:
+                    names.append(field)
+                type_name = SearchFilter.FIELD_TYPES.get(field, field)
+        return [{"type": "responseTemplate", "typeName": t, "fieldName": f} for t, f in fields.items()]
+
+    def set_projection(self, paths=None):
+        self.set_response_template(None if paths is None else self.projection_templates(paths))
+
     def pop(self, key, *args):
         return self.dict.pop(key, *args)
 
@@ -95,49 +117,189 @@ class SearchFilter(object):
 
 class Mind(object):
 
-    def __init__(self, session, level_of_detail="medium"):
+    # Records per page, sized so a medium level-of-detail page stays around 64KB.
+    page_sizes = {'channelSearch': 50,
+                  'recordingFolderItemSearch': 50,
+                  'recordingSearch': 25,
+                  'offerSearch': 25,
+                  'contentSearch': 10,
+                  'collectionSearch': 10}
+    default_page_size = 20
+    # Content ids per multi-id contentSearch; servers that reject a list of ids fall back to one request per id.
+    lookup_batch = 50
+    multi_id_lookup = True
+
+    LAST_PAGE, SHORT_PAGE, FULL_PAGE = range(3)
+
+    def __init__(self, session, level_of_detail="medium", parallel_pages=1, page_sizes=None, cache=None):
         self.session = session
+        self.cache = cache
         self.level_of_detail = level_of_detail
+        self.parallel_pages = parallel_pages
+        self.page_sizes = dict(Mind.page_sizes, **(page_sizes or {}))
+
+    def page_size_for(self, req_type, page_size=None, stream=None):
+        page_size = page_size or self.page_sizes.get(req_type, self.default_page_size)
+        return min(page_size, stream.get('cap', page_size)) if stream else page_size
+
+    def _get_paged_response(self, req_type, payload, target_array, page_size=None, limit=None):
+        return list(self._iter_paged_response(req_type, payload, target_array, page_size, limit))
+
+    def _iter_paged_response(self, req_type, payload, target_array, page_size=None, limit=None):
+        if self.cache is None or not self.cache.cacheable(req_type):
+            return self._iter_pages(req_type, payload, target_array, page_size, limit)
+        key = self.cache.key(req_type, payload, limit)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return iter(cached)
+        first_rpc_id = self.session.rpc_id
+        return self.cache.filling(key, self._iter_pages(req_type, payload, target_array, page_size, limit),
+                                  lambda: self.session.rpc_id - first_rpc_id)
+
+    def _iter_pages(self, req_type, payload, target_array, page_size=None, limit=None):
+        offset = 0
+        window = 1
+        sent = 0
+        # Page caps are learned per stream: a short last page for one filter says nothing about the next.
+        stream = {}
+        try:
+            while True:
+                pages = self._submit_pages(req_type, payload, offset,
+                                           self.page_size_for(req_type, page_size, stream), limit, window)
+                if not pages:
+                    return
+                sent += len(pages)
+                for future, count in pages:
+                    h, b = self.session.wait(future)
+                    items = self._page_items(b, target_array, offset, limit)
+                    offset += len(items)
+                    yield from items
+                    state = self._page_state(stream, b, items, count, offset, limit)
+                    if state == Mind.LAST_PAGE:
+                        return
+                    if state == Mind.SHORT_PAGE:
+                        break
+                window = max(self.parallel_pages, 1)
+        finally:
+            if metrics.enabled:
+                metrics.observe('mind_pages', sent, request_type=req_type)
+
+    def _get_paged_responses(self, req_type, payloads, target_array, page_size=None, limit=None):
+        results = [[] for _ in payloads]
+        streams = [{} for _ in payloads]
+        sent = [0] * len(payloads)
+        active = list(range(len(payloads)))
+        window = 1
+        while active:
+            batches = [(i, self._submit_pages(req_type, payloads[i], len(results[i]),
+                                              self.page_size_for(req_type, page_size, streams[i]), limit, window))
+                       for i in active]
+            for i, pages in batches:
+                sent[i] += len(pages)
+            active = [i for i, pages in batches
+                      if self._collect_pages(streams[i], [(self.session.wait(f), count) for f, count in pages],
+                                             results[i], target_array, limit)]
+            window = max(self.parallel_pages, 1)
+        self._observe_pages(req_type, sent)
+        return results
 
-    def _get_paged_response(self, req_type, payload, target_array, page_size=20, limit=None):
-        results = []
-        payload['count'] = page_size
-        self.session.send_request(req_type, payload)
-        h, b = self.session.get_response()
-        while target_array in b and len(b[target_array]) > 0:
-            results.extend(b[target_array])
-            if (limit is not None and len(results) > limit) or ('isBottom' in b and b['isBottom']):
+    @staticmethod
+    def _observe_pages(req_type, sent):
+        if metrics.enabled:
+            for n in sent:
+                metrics.observe('mind_pages', n, request_type=req_type)
+
+    def _submit_pages(self, req_type, payload, offset, page_size, limit, window):
+        pages = []
+        for n in range(window):
+            start = offset + n * page_size
+            count = page_size if limit is None else min(page_size, limit - start)
+            if count <= 0:
                 break
-            if 'count' in payload:
-                del payload['count']
-            payload['offset'] = len(results)
-            self.session.send_request(req_type, payload)
-            h, b = self.session.get_response()
-        return results
+            page = dict(payload, count=count)
+            if start > 0:
+                page['offset'] = start
+            pages.append((self.session.submit(req_type, page), count))
+        return pages
 
-    def _prepare_search(self, search_type, result_type, filt=None, options=None, page_size=20, limit=None):
+    @staticmethod
+    def _page_items(b, target_array, offset, limit):
+        items = b.get(target_array, [])
+        if limit is not None:
+            items = items[:limit - offset]
+        return items
+
+    @staticmethod
+    def _page_state(stream, b, items, count, offset, limit):
+        # A short page from a server that omits isBottom only becomes the stream's cap once a later page has items.
+        short = stream.pop('short', None)
+        if len(items) == 0 or b.get('isBottom', False) or (limit is not None and offset >= limit):
+            return Mind.LAST_PAGE
+        if short is not None:
+            stream['cap'] = short
+        if len(items) < count:
+            # Either the server caps page sizes or this is a last page without isBottom.  Later offsets
+            # in this window are misaligned either way.
+            if b.get('isBottom') is False:
+                stream['cap'] = len(items)
+            else:
+                stream['short'] = len(items)
+            return Mind.SHORT_PAGE
+        return Mind.FULL_PAGE
+
+    def _collect_pages(self, stream, responses, results, target_array, limit):
+        for (h, b), count in responses:
+            items = self._page_items(b, target_array, len(results), limit)
+            results.extend(items)
+            state = self._page_state(stream, b, items, count, len(results), limit)
+            if state != Mind.FULL_PAGE:
+                return state == Mind.SHORT_PAGE
+        return True
+
+    def _build_payload(self, filt=None, options=None):
         payload = filt if filt is not None else {}
         updates = options if options is not None and isinstance(options, dict) else {}
         if isinstance(payload, SearchFilter):
             payload = payload.get_payload()
-        if not (payload.keys() | options.keys()) & {'levelOfDetail', 'responseTemplate'}:
+        if not (payload.keys() | updates.keys()) & {'levelOfDetail', 'responseTemplate'}:
             updates['levelOfDetail'] = self.level_of_detail
         payload.update(updates)
-        return self._get_paged_response(req_type=search_type,
-                                        payload=payload,
-                                        target_array=result_type,
-                                        page_size=page_size,
-                                        limit=limit)
+        return payload
+
+    def _prepare_search(self, search_type, result_type, filt=None, options=None, page_size=None, limit=None,
+                        stream=False):
+        paged_response = self._iter_paged_response if stream else self._get_paged_response
+        return paged_response(req_type=search_type,
+                              payload=self._build_payload(filt, options),
+                              target_array=result_type,
+                              page_size=page_size,
+                              limit=limit)
+
+    def _prepare_search_many(self, search_type, result_type, filters, options=None, page_size=None, limit=None):
+        return self._get_paged_responses(req_type=search_type,
+                                         payloads=[self._build_payload(f, dict(options or {})) for f in filters],
+                                         target_array=result_type,
+                                         page_size=page_size,
+                                         limit=limit)
 
     def channel_search(self):
         return self._prepare_search(search_type='channelSearch',
                                     result_type='channel',
                                     filt=None,
                                     options={'bodyId': self.session.body_id, 'flatten': True, 'noLimit': True},
-                                    page_size=25,
+                                    page_size=None,
                                     limit=None)
 
-    def recording_folder_item_search(self, filt=None, page_size=20, limit=None):
+    def iter_channel_search(self):
+        return self._prepare_search(search_type='channelSearch',
+                                    result_type='channel',
+                                    filt=None,
+                                    options={'bodyId': self.session.body_id, 'flatten': True, 'noLimit': True},
+                                    page_size=None,
+                                    limit=None,
+                                    stream=True)
+
+    def recording_folder_item_search(self, filt=None, page_size=None, limit=None):
         return self._prepare_search(search_type="recordingFolderItemSearch",
                                     result_type="recordingFolderItem",
                                     filt=filt,
@@ -145,7 +307,16 @@ class Mind(object):
                                     page_size=page_size,
                                     limit=limit)
 
-    def recording_search(self, filt=None, page_size=20, limit=None):
+    def iter_recording_folder_item_search(self, filt=None, page_size=None, limit=None):
+        return self._prepare_search(search_type="recordingFolderItemSearch",
+                                    result_type="recordingFolderItem",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'flatten': True},
+                                    page_size=page_size,
+                                    limit=limit,
+                                    stream=True)
+
+    def recording_search(self, filt=None, page_size=None, limit=None):
         return self._prepare_search(search_type="recordingSearch",
                                     result_type="recording",
                                     filt=filt,
@@ -153,7 +324,16 @@ class Mind(object):
                                     page_size=page_size,
                                     limit=limit)
 
-    def offer_search(self, filt=None, page_size=20, limit=None):
+    def iter_recording_search(self, filt=None, page_size=None, limit=None):
+        return self._prepare_search(search_type="recordingSearch",
+                                    result_type="recording",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'state': ['inProgress', 'scheduled']},
+                                    page_size=page_size,
+                                    limit=limit,
+                                    stream=True)
+
+    def offer_search(self, filt=None, page_size=None, limit=None):
         return self._prepare_search(search_type="offerSearch",
                                     result_type="offer",
                                     filt=filt,
@@ -161,7 +341,16 @@ class Mind(object):
                                     page_size=page_size,
                                     limit=limit)
 
-    def content_search(self, filt=None, page_size=20, limit=None):
+    def iter_offer_search(self, filt=None, page_size=None, limit=None):
+        return self._prepare_search(search_type="offerSearch",
+                                    result_type="offer",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id},
+                                    page_size=page_size,
+                                    limit=limit,
+                                    stream=True)
+
+    def content_search(self, filt=None, page_size=None, limit=None):
         return self._prepare_search(search_type="contentSearch",
                                     result_type="content",
                                     filt=filt,
@@ -169,7 +358,93 @@ class Mind(object):
                                     page_size=page_size,
                                     limit=limit)
 
-    def collection_search(self, filt=None, page_size=20, limit=None):
+    def iter_content_search(self, filt=None, page_size=None, limit=None):
+        return self._prepare_search(search_type="contentSearch",
+                                    result_type="content",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id},
+                                    page_size=page_size,
+                                    limit=limit,
+                                    stream=True)
+
+    def content_search_many(self, filters, page_size=None, limit=None):
+        return self._prepare_search_many(search_type="contentSearch",
+                                         result_type="content",
+                                         filters=filters,
+                                         options={'bodyId': self.session.body_id},
+                                         page_size=page_size,
+                                         limit=limit)
+
+    def content_lookup_many(self, ids, paths=None):
+        payload = self._lookup_payload(paths)
+        found, missing = self._lookup_cached(payload, ids)
+        while missing and self.multi_id_lookup:
+            futures = self._submit_lookups(payload, missing, multi=True)
+            retry = self._collect_lookups(payload, missing, self.session.wait_all(futures), found, multi=True)
+            if len(retry) == len(missing):
+                break
+            missing = retry
+        if missing:
+            futures = self._submit_lookups(payload, missing, multi=False)
+            self._collect_lookups(payload, missing, self.session.wait_all(futures), found, multi=False)
+        return [found.get(id) for id in ids]
+
+    def _lookup_payload(self, paths):
+        # paths are projection paths, as for SearchFilter.set_projection; contentId is always needed.
+        payload = {'bodyId': self.session.body_id}
+        if paths:
+            if 'content.contentId' not in paths:
+                paths = list(paths) + ['content.contentId']
+            payload['responseTemplate'] = SearchFilter.projection_templates(paths)
+        else:
+            payload['levelOfDetail'] = self.level_of_detail
+        return payload
+
+    def _lookup_key(self, payload, id):
+        # Same key as content_search(filt=by_content_id(id), limit=1), so either fills the memo for the other.
+        return self.cache.key('contentSearch', dict(payload, contentId=id), 1)
+
+    def _lookup_cached(self, payload, ids):
+        found = {}
+        wanted = list(collections.OrderedDict.fromkeys(ids))
+        if self.cache is not None and self.cache.cacheable('contentSearch'):
+            for id in wanted:
+                cached = self.cache.get(self._lookup_key(payload, id))
+                if cached:
+                    found[id] = cached[0]
+        return found, [id for id in wanted if id not in found]
+
+    def _lookup_chunks(self, ids, multi):
+        size = self.lookup_batch if multi else 1
+        return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+    def _submit_lookups(self, payload, ids, multi):
+        return [self.session.submit('contentSearch', dict(payload, contentId=chunk if multi else chunk[0],
+                                                          count=len(chunk)))
+                for chunk in self._lookup_chunks(ids, multi)]
+
+    def _collect_lookups(self, payload, ids, responses, found, multi):
+        retry = []
+        for chunk, (h, b) in zip(self._lookup_chunks(ids, multi), responses):
+            if b.get('type') == 'error':
+                if multi:
+                    self.multi_id_lookup = False
+                    retry.extend(chunk)
+                continue
+            contents = b.get('content', [])
+            for content in contents:
+                if content.get('contentId') in chunk:
+                    found[content['contentId']] = content
+                    if self.cache is not None and self.cache.cacheable('contentSearch'):
+                        self.cache.put(self._lookup_key(payload, content['contentId']), [content])
+            if not b.get('isBottom', True):
+                # The server capped the page; shrink later batches to fit.
+                if multi and contents:
+                    self.lookup_batch = min(self.lookup_batch, len(contents))
+                retry.extend(id for id in chunk if id not in found)
+        return retry
+
+    def collection_search(self, filt=None, page_size=None, limit=None):
         return self._prepare_search(search_type="collectionSearch",
                                     result_type="collection",
                                     filt=filt,
@@ -177,12 +452,27 @@ class Mind(object):
                                     page_size=page_size,
                                     limit=limit)
 
+    def iter_collection_search(self, filt=None, page_size=None, limit=None):
+        return self._prepare_search(search_type="collectionSearch",
+                                    result_type="collection",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'omitPgdImages': True},
+                                    page_size=page_size,
+                                    limit=limit,
+                                    stream=True)
+
+    def collection_search_many(self, filters, page_size=None, limit=None):
+        return self._prepare_search_many(search_type="collectionSearch",
+                                         result_type="collection",
+                                         filters=filters,
+                                         options={'bodyId': self.session.body_id, 'omitPgdImages': True},
+                                         page_size=page_size,
+                                         limit=limit)
+
     def send_key(self, key):
-        self.session.send_request('keyEventSend', {'event': key})
-        h, b = self.session.get_response()
+        h, b = self.session.request('keyEventSend', {'event': key})
         return b
 
-
     @staticmethod
     def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
         mrpc = rpc.MRPCSession.new_session(cert_path=cert_path,
@@ -209,7 +499,8 @@ class Mind(object):
 class MindManager(object):
 
     def __init__(self, cert_path, cert_password, address, credential,
-                 port=1413, debug=False, timeout=120):
+                 port=1413, debug=False, timeout=120, size=2, checkout_timeout=None,
+                 keep_warm=0, warm_margin=10, parallel_pages=1, cache=None, reserved=0):
         self.__cert_path = cert_path
         self.__cert_password = cert_password
         self.__address = address
@@ -217,36 +508,190 @@ class MindManager(object):
         self.__port = port
         self.__debug = debug
         self.__timeout = timeout
-        self.__mind = None
+        self.__size = size
+        self.__checkout_timeout = checkout_timeout
+        self.__keep_warm = min(keep_warm, size)
+        self.__warm_margin = warm_margin if keep_warm else 0
+        self.__parallel_pages = parallel_pages
+        self.__cache = cache
+        # Sessions only priority checkouts may take, so a long search can never hold all of them.
+        self.__reserved = min(reserved, size - 1)
+        self.__priority_waiting = 0
+        self.__socket_maker = None
+        self.__body_id = ""
+        self.__idle = []
+        self.__count = 0
+        self.__cond = threading.Condition()
         self.__timer = None
-        pass
 
-    def disconnect(self):
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def open_count(self):
+        return self.__count
+
+    @property
+    def reserved(self):
+        return self.__reserved
+
+    @property
+    def idle_count(self):
+        return len(self.__idle)
+
+    @property
+    def body_id(self):
+        return self.__body_id
+
+    @property
+    def cache(self):
+        return self.__cache
+
+    def _connect(self):
+        if self.__socket_maker is None:
+            self.__socket_maker = rpc.SocketMaker(cert_path=self.__cert_path, cert_password=self.__cert_password)
+        session = rpc.MRPCSession(socket_maker=self.__socket_maker,
+                                  address=self.__address,
+                                  credential=self.__credential,
+                                  port=self.__port,
+                                  debug=self.__debug)
+        session.body_id = self.__body_id
+        session.connect()
+        self.__body_id = session.body_id
+        return Mind(session=session, parallel_pages=self.__parallel_pages, cache=self.__cache)
+
+    def prewarm(self, wait=False):
+        t = threading.Thread(target=self.__warm_up, name='MindManager-prewarm', daemon=True)
+        t.start()
+        if wait:
+            t.join()
+
+    def __warm_up(self):
+        while True:
+            with self.__cond:
+                if len(self.__idle) >= self.__keep_warm or self.__count >= self.__size:
+                    return
+                self.__count += 1
+            try:
+                mind = self._connect()
+            except (OSError, rpc.MRPCError):
+                with self.__cond:
+                    self.__count -= 1
+                    self.__cond.notify_all()
+                return
+            self.release(mind)
+
+    def _close(self, mind):
         try:
-            self.__mind.session.close()
-        except AttributeError:
+            mind.session.close()
+        except OSError:
             pass
-        finally:
-            self.__mind = None
-        if threading.current_thread().getName() == threading.main_thread().getName():
+
+    def checkout(self, timeout=None, priority=False):
+        timeout = timeout if timeout is not None else self.__checkout_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__cond:
+            if priority:
+                self.__priority_waiting += 1
             try:
-                self.__timer.cancel()
-            except AttributeError:
-                pass
+                while True:
+                    if self.__may_take(priority):
+                        while self.__idle:
+                            mind, last_used = self.__idle.pop()
+                            if time.monotonic() - last_used < self.__idle_limit() and mind.session.is_alive():
+                                return mind
+                            self._close(mind)
+                            metrics.inc('mind_reconnects_total', reason='stale')
+                            self.__count -= 1
+                        if self.__count < self.__size:
+                            self.__count += 1
+                            break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if (remaining is not None and remaining <= 0) or not self.__cond.wait(remaining):
+                        raise TimeoutError('No Mind connection available within {} seconds.'.format(timeout))
             finally:
+                if priority:
+                    self.__priority_waiting -= 1
+        try:
+            return self._connect()
+        except BaseException:
+            with self.__cond:
+                self.__count -= 1
+                self.__cond.notify_all()
+            raise
+
+    def __may_take(self, priority):
+        # Priority checkouts go first and may use the reserved sessions; the rest wait their turn.
+        if priority:
+            return True
+        in_use = self.__count - len(self.__idle)
+        return self.__priority_waiting == 0 and in_use < self.__size - self.__reserved
+
+    def release(self, mind):
+        with self.__cond:
+            self.__idle.append((mind, time.monotonic()))
+            self.__schedule_reap()
+            self.__cond.notify_all()
+
+    def discard(self, mind):
+        self._close(mind)
+        metrics.inc('mind_reconnects_total', reason='error')
+        with self.__cond:
+            self.__count -= 1
+            self.__cond.notify_all()
+
+    def __schedule_reap(self):
+        if self.__timer is None and self.__idle:
+            oldest = min(last_used for _, last_used in self.__idle)
+            delay = max(oldest + self.__idle_limit() - time.monotonic(), 0)
+            self.__timer = threading.Timer(delay, self.__reap)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __idle_limit(self):
+        return self.__timeout - self.__warm_margin
+
+    def __reap(self):
+        with self.__cond:
+            self.__timer = None
+            now = time.monotonic()
+            limit = self.__idle_limit()
+            expired = [e for e in self.__idle if now - e[1] >= limit]
+            self.__idle = [e for e in self.__idle if now - e[1] < limit]
+            self.__count -= len(expired)
+            self.__schedule_reap()
+            self.__cond.notify_all()
+        for mind, _ in expired:
+            self._close(mind)
+        if self.__keep_warm:
+            self.prewarm()
+
+    def disconnect(self):
+        with self.__cond:
+            idle = self.__idle
+            self.__idle = []
+            self.__count -= len(idle)
+            if self.__timer is not None:
+                self.__timer.cancel()
                 self.__timer = None
+            self.__cond.notify_all()
+        for mind, _ in idle:
+            self._close(mind)
 
     @contextlib.contextmanager
-    def mind(self):
-        if self.__timer is not None:
-            self.__timer.cancel()
-            self.__timer = None
-        if self.__mind is None:
-            self.__mind = Mind.new_session(cert_path=self.__cert_path,
-                                           cert_password=self.__cert_password,
-                                           address=self.__address,
-                                           credential=self.__credential,
-                                           port=self.__port,
-                                           debug=self.__debug)
-        yield self.__mind
-        self.__timer = threading.Timer(self.__timeout, self.disconnect)
+    def mind(self, timeout=None, priority=False, cached=True):
+        mind = self.checkout(timeout, priority=priority)
+        if not cached:
+            # Bulk loads would flush interactive entries from the cache and could be answered from stale ones.
+            mind.cache = None
+        try:
+            yield mind
+        finally:
+            mind.cache = self.__cache
+            # Only the session's own I/O failures make it unusable; errors raised by the caller's code
+            # (or a nested checkout timing out) leave it healthy.
+            if mind.session.failed is not None:
+                self.discard(mind)
+            else:
+                self.release(mind)
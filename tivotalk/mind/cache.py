@@ -0,0 +1,92 @@
+import collections
+import json
+import threading
+import time
+
+from tivotalk.metrics import registry as metrics
+
+
+class QueryCache(object):
+
+    # Seconds a result stays valid, per request type.  Types not listed are never cached.
+    DEFAULT_TTLS = {'channelSearch': 24 * 3600,
+                    'contentSearch': 6 * 3600,
+                    'collectionSearch': 6 * 3600,
+                    'offerSearch': 900,
+                    'recordingSearch': 300,
+                    'recordingFolderItemSearch': 300}
+    # Results of these types change as guide slots start and end, so they also expire at the next slot boundary.
+    GUIDE_TYPES = frozenset(['offerSearch', 'recordingSearch', 'recordingFolderItemSearch'])
+
+    def __init__(self, ttls=None, max_entries=256, guide_slot=1800):
+        self.ttls = dict(QueryCache.DEFAULT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.guide_slot = guide_slot
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_round_trips = 0
+
+    def cacheable(self, req_type):
+        return self.ttls.get(req_type, 0) > 0
+
+    @staticmethod
+    def key(req_type, payload, limit=None):
+        return req_type, json.dumps(payload, sort_keys=True), limit
+
+    def expiry(self, req_type, now):
+        expires = now + self.ttls[req_type]
+        if self.guide_slot and req_type in self.GUIDE_TYPES:
+            expires = min(expires, (now // self.guide_slot + 1) * self.guide_slot)
+        return expires
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                metrics.inc('mind_cache_lookups_total', request_type=key[0], result='miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc('mind_cache_lookups_total', request_type=key[0], result='hit')
+            self.saved_round_trips += entry[2]
+            return list(entry[1])
+
+    def put(self, key, results, round_trips=1):
+        with self.lock:
+            self.entries[key] = (self.expiry(key[0], time.time()), list(results), round_trips)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def filling(self, key, items, round_trips):
+        results = []
+        for item in items:
+            results.append(item)
+            yield item
+        self.put(key, results, round_trips())
+
+    def invalidate(self, req_type=None):
+        with self.lock:
+            if req_type is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if k[0] == req_type]:
+                    del self.entries[key]
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate,
+                'saved_round_trips': self.saved_round_trips}
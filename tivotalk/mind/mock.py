@@ -0,0 +1,305 @@
+"""A local stand-in for the TiVo Mind RPC service.
+
+MockMindServer speaks MRPC/2 over TLS (or plain TCP), answers
+bodyAuthenticate, bodyConfigSearch and keyEventSend, and serves searches
+from a fixture file with offset/count/isBottom paging.  Latency and the
+server-side page size cap can be injected to model a real box.
+
+    python -m tivotalk.mind.mock --fixtures fixtures.json --port 1413 --latency 0.05
+"""
+
+import argparse
+import collections
+import datetime
+import heapq
+import json
+import operator
+import os
+import random
+import socket
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+
+import tivotalk.mind.api as api
+import tivotalk.mind.rpc as rpc
+
+
+SEARCHES = {'channelSearch': 'channel',
+            'collectionSearch': 'collection',
+            'contentSearch': 'content',
+            'offerSearch': 'offer',
+            'recordingFolderItemSearch': 'recordingFolderItem',
+            'recordingSearch': 'recording'}
+
+KEYWORD_FIELDS = {'titleKeyword': 'title', 'subtitleKeyword': 'subtitle', 'descriptionKeyword': 'description'}
+EXACT_FIELDS = ('contentId', 'collectionId', 'offerId', 'title', 'subtitle')
+TIME_FILTERS = {'minStartTime': (0, operator.ge), 'maxStartTime': (0, operator.le),
+                'minEndTime': (1, operator.ge), 'maxEndTime': (1, operator.le)}
+
+
+def make_certificate(directory, name='mock'):
+    pem = os.path.join(directory, '{}.pem'.format(name))
+    if not os.path.exists(pem):
+        key = os.path.join(directory, '{}.key'.format(name))
+        crt = os.path.join(directory, '{}.crt'.format(name))
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '365',
+                               '-subj', '/CN=localhost', '-keyout', key, '-out', crt],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(pem, 'wt') as out:
+            for part in (crt, key):
+                with open(part, 'rt') as f:
+                    out.write(f.read())
+    return pem
+
+
+def synthetic_fixtures(channels=200, offers=2000, recordings=50, seed=0):
+    rnd = random.Random(seed)
+    titles = ['News', 'The Big Bang Theory', 'Game of Thrones', 'Jeopardy', 'Seinfeld', 'Nova', 'Frontline',
+              'The Simpsons', 'Top Chef', 'Survivor', 'Law & Order', 'The Office', 'Cosmos', 'Planet Earth']
+    now = int(time.time()) // 1800 * 1800
+    fixtures = {'channel': [], 'offer': [], 'content': [], 'recording': []}
+    for n in range(channels):
+        fixtures['channel'].append({'type': 'channel', 'channelNumber': str(100 + n), 'name': 'CH{:03d}HD'.format(n),
+                                    'callSign': 'CH{:03d}'.format(n), 'stationId': 'tivo:st.{:d}'.format(n),
+                                    'isHdtv': n % 2 == 0, 'isReceived': True, 'sourceType': 'cable'})
+    for n in range(offers):
+        title = rnd.choice(titles)
+        channel = rnd.choice(fixtures['channel'])
+        start = now + rnd.randrange(-2, 96) * 1800
+        content = {'type': 'content', 'contentId': 'tivo:ct.{:d}'.format(n), 'title': title,
+                   'subtitle': 'Episode {:d}'.format(n), 'seasonNumber': 1 + n % 9, 'episodeNum': [1 + n % 22],
+                   'description': 'Synthetic description of {} episode {:d}.'.format(title, n),
+                   'collectionId': 'tivo:cl.{:d}'.format(titles.index(title))}
+        fixtures['content'].append(content)
+        fixtures['offer'].append({'type': 'offer', 'offerId': 'tivo:of.{:d}'.format(n), 'title': title,
+                                  'subtitle': content['subtitle'], 'contentId': content['contentId'],
+                                  'collectionId': content['collectionId'], 'duration': 1800,
+                                  'startTime': rpc.MRPCSession.get_date_string(
+                                      datetime.datetime.utcfromtimestamp(start)),
+                                  'channel': {k: channel[k] for k in ('channelNumber', 'name', 'stationId',
+                                                                      'callSign', 'type')}})
+    for n, offer in enumerate(rnd.sample(fixtures['offer'], min(recordings, offers))):
+        fixtures['recording'].append({'type': 'recording', 'recordingId': 'tivo:rc.{:d}'.format(n),
+                                      'title': offer['title'], 'contentId': offer['contentId'],
+                                      'scheduledStartTime': offer['startTime'], 'state': 'scheduled'})
+    return fixtures
+
+
+def record_fixtures(mind, path, hours=24):
+    now = datetime.datetime.utcnow()
+    f = api.SearchFilter()
+    f.by_start_time(min_utc_time=now, max_utc_time=now + datetime.timedelta(hours=hours))
+    fixtures = {'channel': mind.channel_search(),
+                'recording': mind.recording_search(),
+                'offer': mind.offer_search(filt=f)}
+    ids = [api.SearchFilter() for _ in fixtures['recording']]
+    for filt, r in zip(ids, fixtures['recording']):
+        filt.by_content_id(r['contentId'])
+    fixtures['content'] = [c[0] for c in mind.content_search_many(ids, limit=1) if c]
+    with open(path, 'wt') as out:
+        json.dump(fixtures, out)
+    return fixtures
+
+
+class MockMind(object):
+
+    def __init__(self, fixtures, page_size=50, body_id='tsn:0000000000MOCK'):
+        self.fixtures = fixtures
+        self.page_size = page_size
+        self.body_id = body_id
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.times = {}
+        for records in fixtures.values():
+            for r in records:
+                start = r.get('startTime', r.get('scheduledStartTime'))
+                if start is not None:
+                    start = rpc.MRPCSession.get_epoch(start)
+                    self.times[id(r)] = (start, start + r.get('duration', 0))
+
+    def matches(self, record, payload):
+        for key, field in KEYWORD_FIELDS.items():
+            if key in payload and payload[key].lower() not in str(record.get(field, '')).lower():
+                return False
+        for field in EXACT_FIELDS:
+            if field in payload:
+                wanted = payload[field] if isinstance(payload[field], list) else [payload[field]]
+                if record.get(field) not in wanted:
+                    return False
+        if 'stationId' in payload and record.get('channel', record).get('stationId') != payload['stationId']:
+            return False
+        times = self.times.get(id(record))
+        if times is not None:
+            for key, (i, compare) in TIME_FILTERS.items():
+                if key in payload and not compare(times[i], rpc.MRPCSession.get_epoch(payload[key])):
+                    return False
+        return True
+
+    @staticmethod
+    def project(value, templates):
+        if isinstance(value, list):
+            return [MockMind.project(v, templates) for v in value]
+        if not isinstance(value, dict):
+            return value
+        fields = templates.get(value.get('type'))
+        if fields is None:
+            return value
+        return {k: MockMind.project(v, templates) for k, v in value.items() if k in fields or k == 'type'}
+
+    def search(self, req_type, payload):
+        array = SEARCHES[req_type]
+        records = [r for r in self.fixtures.get(array, []) if self.matches(r, payload)]
+        offset = payload.get('offset', 0)
+        count = min(payload.get('count', self.page_size), self.page_size)
+        page = records[offset:offset + count]
+        if 'responseTemplate' in payload:
+            page = self.project(page, {t['typeName']: set(t['fieldName']) for t in payload['responseTemplate']})
+        return {'type': '{}List'.format(array), array: page, 'isBottom': offset + count >= len(records)}
+
+    def handle(self, headers, payload):
+        req_type = payload.get('type', headers.get('RequestType'))
+        with self.lock:
+            self.requests[req_type] += 1
+        if req_type == 'bodyAuthenticate':
+            return {'type': 'bodyAuthenticateResponse', 'status': 'success'}
+        if req_type == 'bodyConfigSearch':
+            return {'type': 'bodyConfigList', 'bodyConfig': [{'type': 'bodyConfig', 'bodyId': self.body_id}]}
+        if req_type == 'keyEventSend':
+            return {'type': 'success'}
+        if req_type in SEARCHES:
+            return self.search(req_type, payload)
+        return {'type': 'error', 'code': 'typeNotSupported', 'text': req_type}
+
+    @staticmethod
+    def encode_response(rpc_id, body):
+        body = json.dumps(body).encode('utf-8')
+        headers = "Type: response\r\nRpcId: {}\r\nContent-Type: application/json\r\n\r\n".format(rpc_id).encode()
+        return b"MRPC/2 %d %d\r\n" % (len(headers), len(body)) + headers + body + b"\n"
+
+
+class MockMindHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        pending = []
+        cond = threading.Condition()
+        closed = []
+        writer = threading.Thread(target=self.write_loop, args=(pending, cond, closed), daemon=True)
+        writer.start()
+        reader = rpc.MRPCFrameReader(self.request)
+        try:
+            while True:
+                headers, body = reader.read_frame()
+                response = server.mind.handle(headers, json.loads(body))
+                due = time.monotonic() + server.delay()
+                with cond:
+                    heapq.heappush(pending, (due, int(headers.get('RpcId', 0)),
+                                             server.mind.encode_response(headers.get('RpcId', 0), response)))
+                    cond.notify()
+        except (rpc.MRPCError, OSError, ValueError):
+            pass
+        finally:
+            with cond:
+                closed.append(True)
+                cond.notify()
+            writer.join()
+
+    def write_loop(self, pending, cond, closed):
+        while True:
+            with cond:
+                while not pending and not closed:
+                    cond.wait()
+                if not pending:
+                    return
+                due, _, data = pending[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    cond.wait(delay)
+                    continue
+                heapq.heappop(pending)
+            try:
+                self.request.sendall(data)
+            except OSError:
+                return
+
+
+class MockMindServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mind, address=('127.0.0.1', 0), cert_path=None, latency=0.0, jitter=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, address, MockMindHandler)
+        self.mind = mind
+        self.latency = latency
+        self.jitter = jitter
+        self.ctx = None
+        if cert_path is not None:
+            self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ctx.load_cert_chain(cert_path)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def delay(self):
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def get_request(self):
+        sock, addr = socketserver.ThreadingTCPServer.get_request(self)
+        if self.ctx is not None:
+            sock = self.ctx.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='MockMindServer', daemon=True)
+        t.start()
+        return t
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PlainSocketMaker(object):
+
+    def get_socket(self):
+        return socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+
+    def save_session(self, sock):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local MRPC/2 stand-in for a TiVo.')
+    parser.add_argument('--fixtures', help='fixture JSON file; synthetic data if omitted')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1413)
+    parser.add_argument('--cert-dir', default='.', help='where mock.pem is created or found')
+    parser.add_argument('--plain', action='store_true', help='serve without TLS')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=50, help='largest page the server returns')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures, 'rt') as f:
+            fixtures = json.load(f)
+    else:
+        fixtures = synthetic_fixtures()
+    cert_path = None if args.plain else make_certificate(args.cert_dir)
+    server = MockMindServer(MockMind(fixtures, page_size=args.page_size), (args.address, args.port),
+                            cert_path=cert_path, latency=args.latency, jitter=args.jitter)
+    print('Mock Mind listening on {}:{:d}{}'.format(args.address, server.port,
+                                                    '' if cert_path is None else ' (cert: {})'.format(cert_path)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
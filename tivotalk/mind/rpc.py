@@ -1,9 +1,16 @@
-import io
+import calendar
+import concurrent.futures
+import datetime
 import json
 import random
 import re
+import select
 import socket
 import ssl
+import threading
+import time
+
+from tivotalk.metrics import registry as metrics
 
 
 class MRPCError(Exception):
@@ -63,10 +70,174 @@ class SocketMaker(object):
         self.ctx.check_hostname = False
         self.ctx.verify_mode = ssl.CERT_NONE
         self.ctx.load_cert_chain(cert_path, password=cert_password)
+        self.session = None
+        self.resumed = 0
 
     def get_socket(self):
         s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-        return self.ctx.wrap_socket(s)
+        return self.ctx.wrap_socket(s, session=self.session)
+
+    def save_session(self, sock):
+        if not isinstance(sock, ssl.SSLSocket):
+            return
+        if sock.session_reused:
+            self.resumed += 1
+        if sock.session is not None and sock.session.has_ticket:
+            self.session = sock.session
+
+
+class JSONCodec(object):
+
+    name = "json"
+
+    @staticmethod
+    def loads(buffer):
+        return json.loads(str(buffer, 'utf-8'))
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode('ascii')
+
+
+class UJSONCodec(object):
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, buffer):
+        return self.ujson.loads(str(buffer, 'utf-8'))
+
+    # ujson escapes '/' and drops separator spaces; keep requests byte-identical to the stdlib.
+    dumps = staticmethod(JSONCodec.dumps)
+
+
+class ORJSONCodec(object):
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+
+    # Requests are small; keep them ASCII-escaped exactly as the stdlib writes them.
+    dumps = staticmethod(JSONCodec.dumps)
+
+
+CODECS = {"orjson": ORJSONCodec, "ujson": UJSONCodec, "json": JSONCodec}
+
+
+def get_codec(name=None):
+    if name is not None:
+        return CODECS[name]()
+    for codec in (ORJSONCodec, UJSONCodec):
+        try:
+            return codec()
+        except ImportError:
+            pass
+    return JSONCodec()
+
+
+class MRPCFrameReader(object):
+
+    preamble_pat = re.compile(rb"MRPC/2 (?P<h_size>\d+) (?P<b_size>\d+)\r\n")
+
+    def __init__(self, sock=None, buffer_size=65536):
+        self.socket = sock
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+        self.frames = 0
+        self.frame_size = 0
+        self.copies = 0
+        self.bytes_read = 0
+
+    def reset(self, sock=None):
+        self.socket = sock
+        self.start = 0
+        self.end = 0
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def _make_room(self, needed):
+        if self.start + needed <= len(self.buffer):
+            return
+        pending = self.pending
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = buffer
+        else:
+            with memoryview(self.buffer) as view:
+                view[:pending] = view[self.start:self.end]
+        if pending:
+            self.copies += 1
+        self.start = 0
+        self.end = pending
+
+    def _fill(self, needed):
+        if self.pending >= needed:
+            return
+        self._make_room(needed)
+        with memoryview(self.buffer) as view:
+            while self.pending < needed:
+                n = self.socket.recv_into(view[self.end:])
+                if n == 0:
+                    raise MRPCError("Connection closed while reading response.")
+                self.end += n
+                self.bytes_read += n
+
+    def poll(self):
+        timeout = self.socket.gettimeout()
+        self._make_room(self.pending + 1)
+        self.socket.setblocking(False)
+        try:
+            with memoryview(self.buffer) as view:
+                n = self.socket.recv_into(view[self.end:])
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return True
+        except OSError:
+            return False
+        finally:
+            self.socket.settimeout(timeout)
+        self.end += n
+        self.bytes_read += n
+        return n > 0
+
+    def _read_preamble(self):
+        while True:
+            eol = self.buffer.find(b"\r\n", self.start, self.end)
+            if eol >= 0:
+                m = self.preamble_pat.search(self.buffer, self.start, eol + 2)
+                if m is None:
+                    raise MRPCError("Malformed MRPC preamble.")
+                self.start = m.end()
+                return int(m.group('h_size')), int(m.group('b_size'))
+            self._fill(self.pending + 1)
+
+    def read_frame(self, loads=None):
+        h_size, b_size = self._read_preamble()
+        self._fill(h_size + b_size)
+        h_end = self.start + h_size
+        b_end = h_end + b_size
+        with memoryview(self.buffer) as view:
+            headers = MRPCSession.parse_headers(str(view[self.start:h_end], 'ascii'))
+            if loads is None:
+                body = bytes(view[h_end:b_end])
+                self.copies += 1
+            else:
+                body = loads(view[h_end:b_end])
+        self.start = b_end
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        self.frames += 1
+        self.frame_size = h_size + b_size
+        return headers, body
 
 
 class MRPCSession(object):
@@ -74,9 +245,8 @@ class MRPCSession(object):
     eol = '\r\n'
     response_count = {True: "multiple", False: "single"}
     schema_version = "17"
-    proto_pat = re.compile("^.*MRPC/2 (?P<h_size>\d+) (?P<b_size>\d+)\r\n")
 
-    def __init__(self, socket_maker, address, credential, port=1413, debug=False):
+    def __init__(self, socket_maker, address, credential, port=1413, debug=False, codec=None):
         self.sm = socket_maker
         self.credential = credential
         self.address = address
@@ -86,91 +256,190 @@ class MRPCSession(object):
         self.rpc_id = 0
         self.body_id = ""
         self.debug = debug
+        self.reader = MRPCFrameReader()
+        self.lock = threading.RLock()
+        self.in_flight = {}
+        self.sent = {}
+        self.codec = codec if codec is not None else get_codec()
+        self.header_cache = {}
+        # The I/O error that left this session's stream unusable, if any.
+        self.failed = None
 
     def connect(self):
+        t0 = time.perf_counter()
         self.socket = self.sm.get_socket()
         self.socket.connect((self.address, self.port))
+        self.reader.reset(self.socket)
+        t1 = time.perf_counter()
+        if metrics.enabled:
+            metrics.inc('mrpc_connects_total')
+            metrics.observe('mrpc_connect_seconds', t1 - t0)
         h, b = self.do_auth()
+        if metrics.enabled:
+            metrics.observe('mrpc_auth_seconds', time.perf_counter() - t1)
+        try:
+            self.check_auth(b)
+        except MRPCError:
+            self.close()
+            raise
+        self.sm.save_session(self.socket)
+        if self.credential.cred_type == "WEB_CREDENTIAL":
+            self.body_id = self.web_body_id(b)
+        elif not self.body_id:
+            h, r = self.request("bodyConfigSearch", {"bodyId": "-"})
+            self.body_id = self.config_body_id(r)
+
+    def check_auth(self, b):
         if 'status' not in b or b["status"] != "success":
             import pprint; pprint.pprint(b); pprint.pprint(self.credential.payload())
-            self.close()
             raise MRPCError("Auth Failure")
-        if self.credential.cred_type == "WEB_CREDENTIAL":
-            try:
-                devices = [d for d in b["deviceId"] if d["friendlyName"] == self.credential.unit_name]
-                if len(devices) > 0:
-                    self.body_id = devices[0]["id"]
-                else:
-                    raise KeyError("No device entry matching unit_name.")
-            except KeyError:
-                self.body_id = "-"
-        else:
-            self.send_request("bodyConfigSearch", {"bodyId": "-"})
-            h, r = self.get_response()
-            try:
-                self.body_id = r['bodyConfig'][0]['bodyId']
-            except KeyError:
-                self.body_id = "-"
+
+    def web_body_id(self, b):
+        try:
+            devices = [d for d in b["deviceId"] if d["friendlyName"] == self.credential.unit_name]
+            if len(devices) > 0:
+                return devices[0]["id"]
+            else:
+                raise KeyError("No device entry matching unit_name.")
+        except KeyError:
+            return "-"
+
+    @staticmethod
+    def config_body_id(r):
+        try:
+            return r['bodyConfig'][0]['bodyId']
+        except KeyError:
+            return "-"
 
     def close(self):
         if self.socket is not None:
             self.socket.shutdown(socket.SHUT_RDWR)
             self.socket.close()
             self.socket = None
-
-    def send_request(self, req_type, payload_json, multiple_responses=False):
+            self.reader.reset()
+        for future in self.in_flight.values():
+            future.set_exception(MRPCError("Session closed with request in flight."))
+        self.in_flight.clear()
+        self.sent.clear()
+
+    def is_alive(self):
+        with self.lock:
+            if self.socket is None:
+                return False
+            try:
+                readable, _, _ = select.select([self.socket], [], [], 0)
+            except (OSError, ValueError):
+                return False
+            return not readable or self.reader.poll()
+
+    def _header_tail(self, req_type, body_id, multiple_responses):
+        key = (req_type, body_id, multiple_responses)
+        tail = self.header_cache.get(key)
+        if tail is None:
+            header_tuples = (
+                ("SchemaVersion", "{}".format(self.schema_version)),
+                ("Content-Type", "application/json"),
+                ("RequestType", req_type),
+                ("ResponseCount", self.response_count[multiple_responses]),
+                ("BodyId", body_id),
+                ("X-ApplicationName", "Quicksilver"),
+                ("X-ApplicationVersion", "1.2"),
+                ("X-ApplicationSessionId", "0x{:x}".format(self.session_id)),
+            )
+            tail = (self.eol.join(["{}: {}".format(k, v) for k, v in header_tuples]) + self.eol * 2).encode('ascii')
+            self.header_cache[key] = tail
+        return tail
+
+    def encode_request(self, rpc_id, req_type, payload_json, multiple_responses=False):
         body_id = ""
         if "bodyId" in payload_json:
             body_id = payload_json["bodyId"]
 
-        header_tuples = (
-            ("Type", "request"),
-            ("RpcId", "{:d}".format(self.rpc_id)),
-            ("SchemaVersion", "{}".format(self.schema_version)),
-            ("Content-Type", "application/json"),
-            ("RequestType", req_type),
-            ("ResponseCount", self.response_count[multiple_responses]),
-            ("BodyId", body_id),
-            ("X-ApplicationName", "Quicksilver"),
-            ("X-ApplicationVersion", "1.2"),
-            ("X-ApplicationSessionId", "0x{:x}".format(self.session_id)),
-        )
-
-        headers = self.eol.join(["{}: {}".format(k, v) for k, v in header_tuples]) + self.eol
+        headers = b"Type: request\r\nRpcId: %d\r\n" % rpc_id + self._header_tail(req_type, body_id, multiple_responses)
 
         payload_json['type'] = req_type
-        payload = json.dumps(payload_json)
-        preamble = "MRPC/2 {:d} {:d}".format(len(headers) + 2, len(payload))
-        request = preamble + self.eol + headers + self.eol + payload + "\n"
-        self.rpc_id += 1
+        payload = self.codec.dumps(payload_json)
+        preamble = b"MRPC/2 %d %d\r\n" % (len(headers), len(payload))
+        return b"".join((preamble, headers, payload, b"\n"))
+
+    def next_rpc_id(self):
+        with self.lock:
+            rpc_id = self.rpc_id
+            self.rpc_id += 1
+            return rpc_id
+
+    def send_request(self, req_type, payload_json, multiple_responses=False):
+        with self.lock:
+            rpc_id = self.next_rpc_id()
+            data = self.encode_request(rpc_id, req_type, payload_json, multiple_responses)
+            try:
+                self.socket.sendall(data)
+            except OSError as e:
+                self.failed = e
+                raise
+        if metrics.enabled:
+            metrics.inc('mrpc_bytes_sent_total', len(data), request_type=req_type)
+        return rpc_id
+
+    def _track(self, rpc_id, req_type):
+        if metrics.enabled:
+            self.sent[rpc_id] = (req_type, time.perf_counter())
+
+    def submit(self, req_type, payload_json):
+        with self.lock:
+            future = concurrent.futures.Future()
+            rpc_id = self.send_request(req_type, payload_json)
+            self.in_flight[rpc_id] = future
+            self._track(rpc_id, req_type)
+            return future
+
+    def _read_response(self):
+        try:
+            headers, body = self.reader.read_frame(self.codec.loads)
+        except (OSError, MRPCError, ValueError) as e:
+            # A short or garbled frame leaves the stream out of step with the requests.
+            self.failed = e
+            raise
+        if self.debug:
+            print("RPC Response (Frames: {:d}, Pending: {:d})".format(self.reader.frames, self.reader.pending))
+        return headers, body
 
-        self.socket.sendall(request.encode('ascii'))
+    def _dispatch(self, headers, body):
+        try:
+            rpc_id = int(headers['RpcId'])
+            future = self.in_flight.pop(rpc_id)
+        except (KeyError, ValueError):
+            return False
+        if self.sent:
+            sent = self.sent.pop(rpc_id, None)
+            if sent is not None:
+                metrics.observe('mrpc_rtt_seconds', time.perf_counter() - sent[1], request_type=sent[0])
+                metrics.inc('mrpc_bytes_received_total', self.reader.frame_size, request_type=sent[0])
+        future.set_result((headers, body))
+        return True
+
+    def wait(self, future):
+        with self.lock:
+            while not future.done():
+                self._dispatch(*self._read_response())
+        return future.result()
+
+    def wait_all(self, futures):
+        return [self.wait(f) for f in futures]
+
+    def request(self, req_type, payload_json):
+        return self.wait(self.submit(req_type, payload_json))
 
     @staticmethod
     def parse_headers(buffer):
         return dict([line.split(': ', 1) for line in buffer.split('\r\n') if len(line) > 0])
 
     def get_response(self):
-        buffer = io.BytesIO()
-        buffer.write(self.socket.recv())
-        while b"\n" not in buffer.getvalue():
-            buffer.write(self.socket.recv())
-        buf_val = buffer.getvalue().decode()
-        m = self.proto_pat.search(buf_val)
-        h_size = int(m.groupdict()['h_size'])
-        b_size = int(m.groupdict()['b_size'])
-        h_start = m.span()[-1]
-        if self.debug:
-            print("RPC Response (Offset: {:d}, H Size: {:d}, B Size: {:d})".format(h_start, h_size, b_size))
-            print("RPC Response (Bytes Loaded: {:d})".format(buffer.tell() - h_start))
-        while buffer.tell() - h_start < h_size + b_size:
-            buffer.write(self.socket.recv())
-            if self.debug:
-                print("RPC Response (Bytes Loaded: {:d})".format(buffer.tell() - h_start))
-        buf_val = buffer.getvalue().decode()
-        headers = self.parse_headers(buf_val[h_start:h_start+h_size])
-        response_json = json.loads(buf_val[h_start+h_size:])
-        return headers, response_json
+        with self.lock:
+            while True:
+                headers, body = self._read_response()
+                if not self._dispatch(headers, body):
+                    return headers, body
 
     def do_auth(self):
         self.send_request("bodyAuthenticate", self.credential.payload())
@@ -186,30 +455,35 @@ class MRPCSession(object):
         return date_time.strftime("%Y-%m-%d %H:%M:%S")
 
     @staticmethod
-    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
-        sm = SocketMaker(cert_path=cert_path, cert_password=cert_password)
-        return MRPCSession(socket_maker=sm,
-                           address=address,
-                           credential=credential,
-                           port=port,
-                           debug=debug)
+    def get_epoch(date_string):
+        # fromisoformat parses the "%Y-%m-%d %H:%M:%S" form several times faster than strptime.
+        return calendar.timegm(datetime.datetime.fromisoformat(date_string).timetuple())
 
-    @staticmethod
-    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+    @classmethod
+    def new_session(cls, cert_path, cert_password, address, credential, port=1413, debug=False):
+        sm = SocketMaker(cert_path=cert_path, cert_password=cert_password)
+        return cls(socket_maker=sm,
+                   address=address,
+                   credential=credential,
+                   port=port,
+                   debug=debug)
+
+    @classmethod
+    def new_local_session(cls, cert_path, cert_password, address, mak, port=1413, debug=False):
         cred = MRPCCredential.new_mak(mak=mak)
-        return MRPCSession.new_session(cert_path=cert_path,
-                                       cert_password=cert_password,
-                                       address=address,
-                                       credential=cred,
-                                       port=port,
-                                       debug=debug)
-
-    @staticmethod
-    def new_web_session(cert_path, cert_password, username, password, unit_name, debug=False):
+        return cls.new_session(cert_path=cert_path,
+                               cert_password=cert_password,
+                               address=address,
+                               credential=cred,
+                               port=port,
+                               debug=debug)
+
+    @classmethod
+    def new_web_session(cls, cert_path, cert_password, username, password, unit_name, debug=False):
         cred = MRPCCredential.new_web(username=username, password=password, unit_name=unit_name)
-        return MRPCSession.new_session(cert_path=cert_path,
-                                       cert_password=cert_password,
-                                       address="middlemind.tivo.com",
-                                       credential=cred,
-                                       port=443,
-                                       debug=debug)
+        return cls.new_session(cert_path=cert_path,
+                               cert_password=cert_password,
+                               address="middlemind.tivo.com",
+                               credential=cred,
+                               port=443,
+                               debug=debug)
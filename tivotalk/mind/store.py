@@ -0,0 +1,208 @@
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import tivotalk.mind.api as api
+import tivotalk.mind.rpc as rpc
+
+
+logger = logging.getLogger('tivoproxy')
+
+
+SCHEMA = """
+-- Written through by TELLABOUT lookups; MindSync only fetches offers and recordings.
+CREATE TABLE IF NOT EXISTS content (
+    content_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated INTEGER NOT NULL
+);
+DROP TABLE IF EXISTS collection;
+CREATE TABLE IF NOT EXISTS offer (
+    offer_id TEXT PRIMARY KEY,
+    content_id TEXT,
+    collection_id TEXT,
+    station_id TEXT,
+    title TEXT,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offer_start ON offer (start_time);
+CREATE INDEX IF NOT EXISTS offer_station_start ON offer (station_id, start_time);
+CREATE INDEX IF NOT EXISTS offer_end ON offer (end_time);
+CREATE TABLE IF NOT EXISTS recording (
+    recording_id TEXT PRIMARY KEY,
+    content_id TEXT,
+    title TEXT,
+    start_time INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recording_start ON recording (start_time);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+OFFER_PROJECTION = ['offer.offerId', 'offer.contentId', 'offer.collectionId', 'offer.title', 'offer.subtitle',
+                    'offer.startTime', 'offer.duration', 'offer.channel.stationId', 'offer.channel.name']
+RECORDING_PROJECTION = ['recording.recordingId', 'recording.contentId', 'recording.title',
+                        'recording.scheduledStartTime']
+
+
+class MindStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get_state(self, name, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_state(self, name, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+    def covers(self, start, end, max_age=None):
+        synced_from = self.get_state('offer_from')
+        synced_until = self.get_state('offer_until')
+        if max_age is not None:
+            synced = self.get_state('offer_synced')
+            if synced is None or time.time() - synced >= max_age:
+                return False
+        return synced_from is not None and synced_from <= start and end <= synced_until
+
+    def put_contents(self, contents):
+        now = int(time.time())
+        rows = [(c['contentId'], json.dumps(c), now) for c in contents if 'contentId' in c]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO content (content_id, data, updated) VALUES (?, ?, ?)", rows)
+
+    def get_contents(self, content_ids, max_age=None):
+        content_ids = list(content_ids)
+        oldest = 0 if max_age is None else int(time.time()) - max_age
+        with self.lock:
+            rows = self.db.execute("SELECT content_id, data FROM content WHERE updated >= ? AND content_id IN ({})"
+                                   .format(','.join('?' * len(content_ids))), [oldest] + content_ids).fetchall()
+        return {content_id: json.loads(data) for content_id, data in rows}
+
+    def put_offers(self, offers):
+        rows = []
+        for o in offers:
+            start = rpc.MRPCSession.get_epoch(o['startTime'])
+            rows.append((o['offerId'], o.get('contentId'), o.get('collectionId'),
+                         o.get('channel', {}).get('stationId'), o.get('title', '').lower(),
+                         start, start + o.get('duration', 0), json.dumps(o)))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO offer (offer_id, content_id, collection_id, station_id, "
+                                "title, start_time, end_time, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def find_offers(self, title, start, end, station_id=None, limit=None):
+        sql = "SELECT data FROM offer WHERE start_time >= ? AND start_time <= ?"
+        params = [start, end]
+        for word in title.lower().split():
+            sql += " AND title LIKE ?"
+            params.append('%{}%'.format(word))
+        if station_id is not None:
+            sql += " AND station_id = ?"
+            params.append(station_id)
+        sql += " ORDER BY start_time"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def prune_offers(self, before):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM offer WHERE end_time < ?", (before,))
+
+    def replace_recordings(self, recordings):
+        rows = [(r['recordingId'], r.get('contentId'), r.get('title'),
+                 rpc.MRPCSession.get_epoch(r['scheduledStartTime']), json.dumps(r))
+                for r in recordings if 'scheduledStartTime' in r]
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM recording")
+            self.db.executemany("INSERT INTO recording (recording_id, content_id, title, start_time, data) "
+                                "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def find_recordings(self, start, end):
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM recording WHERE start_time >= ? AND start_time <= ? "
+                                   "ORDER BY start_time", (start, end)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+
+class MindSync(object):
+
+    def __init__(self, store, manager, interval=1800, horizon=12 * 3600, retention=24 * 3600):
+        self.store = store
+        self.manager = manager
+        self.interval = interval
+        self.horizon = horizon
+        self.retention = retention
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def recordings_fresh(self):
+        synced = self.store.get_state('recording_synced')
+        return synced is not None and time.time() - synced < 2 * self.interval
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='MindSync', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sync()
+            except Exception:
+                # Keep the thread alive; stale data ages out of covers() and recordings_fresh.
+                logger.exception('Mind sync failed.')
+            self.stopped.wait(self.interval)
+
+    def sync(self):
+        now = int(time.time())
+        until = now + self.horizon
+        cursor = self.store.get_state('offer_until')
+        f = api.SearchFilter()
+        f.set_projection(OFFER_PROJECTION)
+        if cursor is None or cursor < now:
+            synced_from = now
+            f.by_end_time(min_utc_time=datetime.datetime.utcfromtimestamp(now))
+            f.by_start_time(max_utc_time=datetime.datetime.utcfromtimestamp(until))
+        else:
+            synced_from = max(self.store.get_state('offer_from'), now - self.retention)
+            f.by_start_time(min_utc_time=datetime.datetime.utcfromtimestamp(cursor),
+                            max_utc_time=datetime.datetime.utcfromtimestamp(until))
+        with self.manager.mind(cached=False) as m:
+            offers = m.offer_search(filt=f)
+            r = api.SearchFilter()
+            r.set_projection(RECORDING_PROJECTION)
+            recordings = m.recording_search(filt=r)
+        self.store.put_offers(offers)
+        self.store.prune_offers(synced_from)
+        self.store.replace_recordings(recordings)
+        self.store.set_state('offer_from', synced_from)
+        self.store.set_state('offer_until', until)
+        self.store.set_state('offer_synced', now)
+        self.store.set_state('recording_synced', now)
+        logger.info('Mind sync stored {:d} offers and {:d} recordings.'.format(len(offers), len(recordings)))
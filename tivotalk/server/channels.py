@@ -0,0 +1,141 @@
+import collections
+import json
+import os
+import re
+import threading
+
+from fuzzywuzzy import process
+
+
+NON_ALNUM = re.compile('[^a-z0-9]+')
+
+
+def normalize(name):
+    return NON_ALNUM.sub(' ', str(name).lower()).strip()
+
+
+def trigrams(text):
+    padded = '  {} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ChannelRecord(object):
+
+    __slots__ = ('channel_number', 'name', 'call_sign', 'station_id', 'is_hdtv')
+
+    FIELDS = ('channelNumber', 'name', 'callSign', 'stationId', 'isHdtv')
+
+    def __init__(self, channel_number, name, call_sign, station_id, is_hdtv):
+        self.channel_number = channel_number
+        self.name = name
+        self.call_sign = call_sign
+        self.station_id = station_id
+        self.is_hdtv = is_hdtv
+
+    def __repr__(self):
+        return 'ChannelRecord({} {} {})'.format(self.channel_number, self.name, self.station_id)
+
+    def row(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    @staticmethod
+    def from_channel(channel):
+        return ChannelRecord(*[channel.get(field) for field in ChannelRecord.FIELDS])
+
+
+class Lineup(object):
+
+    def __init__(self, records, source=None):
+        self.records = records
+        self.source = source
+        self.by_station = {r.station_id: r for r in records}
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def full_record(self, station_id):
+        with open(self.source, 'rt') as cf:
+            for c in json.load(cf):
+                if c.get('stationId') == station_id:
+                    return c
+        raise KeyError(station_id)
+
+    def save(self, cache_path):
+        with open(cache_path, 'wt') as cf:
+            json.dump([r.row() for r in self.records], cf, separators=(',', ':'))
+
+    @staticmethod
+    def from_channels(channels, source=None):
+        return Lineup([ChannelRecord.from_channel(c) for c in channels if c.get('isReceived')], source=source)
+
+    @staticmethod
+    def load(path, cache_path=None):
+        cache_path = cache_path or path + '.lineup'
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(path):
+                with open(cache_path, 'rt') as cf:
+                    return Lineup([ChannelRecord(*row) for row in json.load(cf)], source=path)
+        except (OSError, ValueError, TypeError):
+            pass
+        with open(path, 'rt') as cf:
+            lineup = Lineup.from_channels(json.load(cf), source=path)
+        try:
+            lineup.save(cache_path)
+        except OSError:
+            pass
+        return lineup
+
+
+class ChannelIndex(object):
+
+    KEY_FIELDS = {'c_name': 'name', 'c_num': 'channel_number'}
+
+    def __init__(self, lineup, hd_only=True, candidates=16, memo_size=256):
+        self.candidates = candidates
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+        self.memo_lock = threading.Lock()
+        self.keys = {kind: {} for kind in self.KEY_FIELDS}
+        self.aliases = {kind: {} for kind in self.KEY_FIELDS}
+        self.postings = {kind: collections.defaultdict(set) for kind in self.KEY_FIELDS}
+        for c in lineup:
+            if hd_only and not c.is_hdtv:
+                continue
+            for kind, field in self.KEY_FIELDS.items():
+                key = getattr(c, field)
+                self.keys[kind][key] = c
+                self.aliases[kind].setdefault(normalize(key), c)
+                for gram in trigrams(normalize(key)):
+                    self.postings[kind][gram].add(key)
+            if c.call_sign:
+                self.aliases['c_name'].setdefault(normalize(c.call_sign), c)
+
+    def __len__(self):
+        return len(self.keys['c_name'])
+
+    def _candidates(self, kind, text):
+        counts = collections.Counter()
+        for gram in trigrams(text):
+            counts.update(self.postings[kind].get(gram, ()))
+        return [key for key, _ in counts.most_common(self.candidates)]
+
+    def match(self, kind, spoken):
+        text = normalize(spoken)
+        memo_key = (kind, text)
+        with self.memo_lock:
+            if memo_key in self.memo:
+                self.memo.move_to_end(memo_key)
+                return self.memo[memo_key]
+        channel = self.aliases[kind].get(text)
+        if channel is None:
+            options = self._candidates(kind, text) or list(self.keys[kind])
+            match = process.extractOne(spoken, options)
+            channel = self.keys[kind][match[0]] if match is not None else None
+        with self.memo_lock:
+            self.memo[memo_key] = channel
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return channel
@@ -0,0 +1,74 @@
+import json
+import urllib.parse
+
+import tivotalk.server.wire as wire
+
+
+class ChunkedResult(object):
+    """A list result published as a sequence of size-bounded messages.
+
+    Items are pulled from ``items`` lazily, so a generator over ``iter_*``
+    pages is published as the pages arrive.  Every message carries ``seq``;
+    the final one also has ``last`` and ``total_count``.  With ``packed``
+    each chunk's list goes out in the compact wire format, marked ``v``.
+    """
+
+    # PubNub rejects messages over 32KiB, envelope included, measured after URL-encoding (the SDK
+    # publishes with GET), so sizes are counted on the escaped JSON.
+    MAX_BYTES = 24 * 1024
+    MAX_ITEMS = 25
+
+    def __init__(self, fields, list_key, items, max_bytes=None, max_items=None, packed=False,
+                 compress_bytes=wire.COMPRESS_BYTES):
+        self.fields = fields
+        self.list_key = list_key
+        self.items = items
+        self.max_bytes = max_bytes or ChunkedResult.MAX_BYTES
+        self.max_items = max_items or ChunkedResult.MAX_ITEMS
+        self.packed = packed
+        self.compress_bytes = compress_bytes
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def message(self, correlation_id, seq, chunk, total=None):
+        msg = dict(self.fields, seq=seq)
+        if self.packed:
+            msg['v'] = wire.VERSION
+            msg[self.list_key] = wire.pack_list(self.list_key, chunk, self.compress_bytes)
+        else:
+            msg[self.list_key] = chunk
+        if correlation_id is not None:
+            msg['id'] = correlation_id
+        if total is not None:
+            msg['last'] = True
+            msg['total_count'] = total
+        return msg
+
+    @staticmethod
+    def size(value):
+        return len(urllib.parse.quote(json.dumps(value), safe=''))
+
+    def messages(self, correlation_id=None):
+        overhead = self.size(self.message(correlation_id, 0, [], 0))
+        chunk = []
+        size = overhead
+        seq = 0
+        total = 0
+        try:
+            for item in self.items:
+                # Plus the escaped ", " separator.
+                n = self.size(item) + 6
+                if chunk and (size + n > self.max_bytes or len(chunk) >= self.max_items):
+                    yield self.message(correlation_id, seq, chunk)
+                    seq += 1
+                    chunk = []
+                    size = overhead
+                chunk.append(item)
+                size += n
+                total += 1
+            yield self.message(correlation_id, seq, chunk, total)
+        finally:
+            close = getattr(self.items, 'close', None)
+            if close is not None:
+                close()
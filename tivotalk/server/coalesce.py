@@ -0,0 +1,117 @@
+import collections
+import threading
+
+from tivotalk.metrics import registry as metrics
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.items = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+    """Shares one in-flight result stream between identical requests.
+
+    The first request for a key (the leader) pulls items from its source;
+    requests for the same key that arrive before it finishes follow along,
+    replaying what the leader has already seen and then waiting for the
+    rest.  Each caller still gets its own iterator, so every requester is
+    answered with its own chunks.
+    """
+
+    def __init__(self, on_lead=None):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counts = collections.Counter()
+        # Called with the key whenever a new search starts.
+        self.on_lead = on_lead
+
+    def iter(self, key, source):
+        # A generator, so nothing joins a flight until the caller starts pulling items.
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                leader = True
+            else:
+                leader = False
+                with flight.cond:
+                    flight.followers += 1
+            self.counts['leader' if leader else 'hit'] += 1
+        metrics.inc('proxy_coalesced_total', cmd=key[0], result='leader' if leader else 'hit')
+        if leader:
+            if self.on_lead is not None:
+                self.on_lead(key)
+            yield from self.lead(key, flight, source)
+        else:
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+            yield from self.follow(flight)
+
+    def lead(self, key, flight, source):
+        finished = False
+        try:
+            for item in source:
+                with flight.cond:
+                    flight.items.append(item)
+                    flight.cond.notify_all()
+                yield item
+            finished = True
+        except GeneratorExit:
+            # Our own requester went away; finish the search for anyone following it.
+            with flight.cond:
+                following = flight.followers > 0
+            if following:
+                for item in source:
+                    with flight.cond:
+                        flight.items.append(item)
+                        flight.cond.notify_all()
+                finished = True
+            raise
+        except Exception as e:
+            with flight.cond:
+                flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            with flight.cond:
+                if not finished and flight.error is None:
+                    flight.error = ConnectionError('Coalesced request was abandoned.')
+                flight.done = True
+                flight.cond.notify_all()
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    @staticmethod
+    def follow(flight):
+        i = 0
+        while True:
+            with flight.cond:
+                while i >= len(flight.items) and not flight.done:
+                    flight.cond.wait()
+                if i < len(flight.items):
+                    item = flight.items[i]
+                elif flight.error is not None:
+                    raise flight.error
+                else:
+                    return
+            i += 1
+            yield item
+
+    def active(self, key):
+        with self.lock:
+            return key in self.flights
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.flights),
+                    'leaders': self.counts['leader'],
+                    'hits': self.counts['hit']}
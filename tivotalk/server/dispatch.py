@@ -0,0 +1,218 @@
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from tivotalk.metrics import registry as metrics
+from tivotalk.server.chunks import ChunkedResult
+
+
+logger = logging.getLogger('tivoproxy')
+
+
+class LaneStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean_wait': self.total_wait / self.count if self.count else 0.0,
+                'max_wait': self.max_wait}
+
+
+class CommandDispatcher(object):
+
+    TRANSPORT = 0
+    SEARCH = 1
+    LANES = {'PAUSE': TRANSPORT, 'RESUME': TRANSPORT, 'ADVANCE': TRANSPORT}
+    LANE_NAMES = {TRANSPORT: 'transport', SEARCH: 'search'}
+    # Their sum stays below the worker count and the pool size, so duplicates and other commands
+    # still find a worker and a session while every limited search is running.
+    LIMITS = {'WHENIS': 1, 'WHATSON': 1, 'TELLABOUT': 1}
+    DEFERRED, STARTED, JOINED = range(3)
+
+    def __init__(self, handler, publish, workers=4, limits=None, max_queue=32, joinable=None,
+                 transport_workers=2):
+        self.handler = handler
+        self.publish = publish
+        # joinable(msg) is true when msg would share a search already running, so it needs no slot of its own.
+        self.joinable = joinable
+        self.limits = dict(CommandDispatcher.LIMITS, **(limits or {}))
+        self.max_queue = max_queue
+        self.queue = queue.PriorityQueue()
+        # Transport commands get workers of their own, so a PAUSE never waits behind streaming searches.
+        self.transport_queue = queue.Queue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.slot_free = threading.Condition(self.lock)
+        self.local = threading.local()
+        self.running = collections.Counter()
+        self.deferred = collections.defaultdict(collections.deque)
+        self.lanes = {self.TRANSPORT: LaneStats(), self.SEARCH: LaneStats()}
+        self.rejected = 0
+        self.joined = 0
+        self.max_depth = 0
+        self.threads = [threading.Thread(target=self.work, args=(self.queue,), name='CommandWorker-{:d}'.format(i),
+                                         daemon=True)
+                        for i in range(workers)]
+        self.threads += [threading.Thread(target=self.work, args=(self.transport_queue,),
+                                          name='TransportWorker-{:d}'.format(i), daemon=True)
+                         for i in range(transport_workers)]
+        for t in self.threads:
+            t.start()
+
+    @property
+    def depth(self):
+        return self.queue.qsize() + self.transport_queue.qsize() + sum(len(d) for d in self.deferred.values())
+
+    def lane(self, msg):
+        return self.LANES.get(msg['cmd'].upper(), self.SEARCH)
+
+    def submit(self, msg):
+        lane = self.lane(msg)
+        with self.lock:
+            depth = self.depth
+            if lane != self.TRANSPORT and depth >= self.max_queue:
+                self.rejected += 1
+                reject = True
+            else:
+                reject = False
+                self.max_depth = max(self.max_depth, depth + 1)
+                q = self.transport_queue if lane == self.TRANSPORT else self.queue
+                q.put((lane, next(self.seq), time.monotonic(), msg))
+                metrics.set('proxy_queue_depth', depth + 1)
+        if reject:
+            logger.warning('Command queue full ({:d}), rejecting {}.'.format(depth, msg['cmd']))
+            self._send(msg, {'cmd': msg['cmd'], 'status': 'BUSY'})
+        return not reject
+
+    def _acquire(self, item):
+        cmd = item[3]['cmd'].upper()
+        limit = self.limits.get(cmd)
+        # Checked outside the lock: it may parse dates and match channels.
+        if limit is not None and self._joins(item[3]):
+            with self.lock:
+                self.joined += 1
+            return self.JOINED
+        with self.lock:
+            if limit is not None and self.running[cmd] >= limit:
+                self.deferred[cmd].append(item)
+                return self.DEFERRED
+            self.running[cmd] += 1
+            return self.STARTED
+
+    def _joins(self, msg):
+        if self.joinable is None:
+            return False
+        try:
+            return self.joinable(msg)
+        except Exception:
+            # The handler will report the bad command; it just doesn't get to skip the queue.
+            return False
+
+    def wake(self, cmd):
+        # A search for cmd just started; deferred duplicates of it can now join instead of waiting.
+        cmd = cmd.upper()
+        with self.lock:
+            items, self.deferred[cmd] = self.deferred[cmd], collections.deque()
+        for item in items:
+            self.queue.put(item)
+
+    def lead(self, cmd):
+        # Called on the worker whose command starts a search for cmd.  A duplicate let in to join a
+        # search that has since finished ends up running its own, and takes a slot for it first.
+        self.wake(cmd)
+        if getattr(self.local, 'slot', True):
+            return
+        cmd = cmd.upper()
+        limit = self.limits.get(cmd)
+        with self.slot_free:
+            while limit is not None and self.running[cmd] >= limit:
+                self.slot_free.wait()
+            self.running[cmd] += 1
+        self.local.slot = True
+
+    def _release(self, cmd):
+        cmd = cmd.upper()
+        with self.lock:
+            self.running[cmd] -= 1
+            self.slot_free.notify_all()
+            if self.deferred[cmd]:
+                self.queue.put(self.deferred[cmd].popleft())
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            state = self._acquire(item)
+            if metrics.enabled:
+                with self.lock:
+                    depth = self.depth
+                metrics.set('proxy_queue_depth', depth)
+            if state != self.DEFERRED:
+                # A duplicate of a running search only waits on and republishes its results, so it runs
+                # without a slot unless that search ends first (see lead).
+                self.run(item, slot=state == self.STARTED)
+
+    def run(self, item, slot=True):
+        lane, _, enqueued, msg = item
+        wait = time.monotonic() - enqueued
+        with self.lock:
+            self.lanes[lane].record(wait)
+        metrics.observe('proxy_queue_wait_seconds', wait, lane=self.LANE_NAMES[lane])
+        # Timed here rather than in the handler: list results are produced while they are published.
+        t0 = time.perf_counter()
+        status = 'ERROR'
+        self.local.slot = slot
+        try:
+            r = self.handler(msg)
+            logger.debug('Result: {}'.format(str(r)))
+            if isinstance(r, ChunkedResult):
+                # Pulling each chunk may block on the next page from the TiVo.
+                for m in r.messages(msg.get('id')):
+                    if not self._send(msg, m):
+                        break
+                else:
+                    status = r.get('status', 'NONE')
+            elif r is not None:
+                if self._send(msg, r):
+                    status = r.get('status', 'NONE')
+            else:
+                status = 'NONE'
+        except Exception:
+            logger.exception('Command {} failed.'.format(msg['cmd']))
+            self._send(msg, {'cmd': msg['cmd'], 'status': 'ERROR'})
+        finally:
+            metrics.observe('proxy_command_seconds', time.perf_counter() - t0,
+                            cmd=msg['cmd'].upper(), status=status)
+            if self.local.slot:
+                self._release(msg['cmd'])
+
+    def _send(self, msg, response):
+        if 'id' in msg and 'id' not in response:
+            response = dict(response, id=msg['id'])
+        logger.info('Sending response...')
+        try:
+            self.publish(message=response)
+            return True
+        except Exception:
+            logger.exception('Failed to publish response to {}.'.format(msg['cmd']))
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {'depth': self.depth,
+                    'max_depth': self.max_depth,
+                    'rejected': self.rejected,
+                    'joined': self.joined,
+                    'running': dict(self.running),
+                    'wait': {self.LANE_NAMES[lane]: stats.as_dict() for lane, stats in self.lanes.items()}}
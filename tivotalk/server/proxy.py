@@ -1,14 +1,24 @@
 import arrow
+import calendar
 import datetime
 import json
 import logging
+import threading
 import time
 
-from fuzzywuzzy import process
-
+from tivotalk.server.channels import ChannelIndex, Lineup
+from tivotalk.server.chunks import ChunkedResult
+from tivotalk.server.coalesce import SingleFlight
+from tivotalk.server.dispatch import CommandDispatcher
 from tivotalk.server.pubcom import Communicator
+from tivotalk.server.recordings import RecordingIndex
+from tivotalk.server.transport import transport_from_config
+import tivotalk.server.wire as wire
+import tivotalk.metrics as metrics
 import tivotalk.mind.api as api
+import tivotalk.mind.cache as cache
 import tivotalk.mind.rpc as rpc
+import tivotalk.mind.store as store
 import lambdaskill.utils as utils
 
 
@@ -22,6 +32,20 @@ if logger.level == logging.NOTSET:
 
 LOCAL_TZ = time.tzname[time.localtime().tm_isdst]
 
+PROJECTIONS = {
+    'WHATSON': ['recording.title', 'recording.contentId', 'recording.scheduledStartTime'],
+    'TELLABOUT': ['content.title', 'content.subtitle', 'content.seasonNumber', 'content.episodeNum',
+                  'content.description', 'content.contentId'],
+    'WHENIS': ['offer.title', 'offer.subtitle', 'offer.contentId', 'offer.offerId', 'offer.startTime',
+               'offer.channel.name'],
+}
+# Detail fields sent back for TELLABOUT; contentId is only projected to match results to requests.
+TELLABOUT_FIELDS = [p.split('.')[-1] for p in PROJECTIONS['TELLABOUT'] if p != 'content.contentId']
+
+
+def to_epoch(a):
+    return calendar.timegm(a.utctimetuple())
+
 
 def channel_to_identifier(channel):
     keys = channel.keys() & {'channelNumber', 'sourceType', 'stationId'}
@@ -31,29 +55,66 @@ def channel_to_identifier(channel):
 class TiVoProxy(object):
 
     def __init__(self, config):
+        self.metrics_server = None
+        if config.get('TT_METRICS_PORT'):
+            metrics.enable()
+            self.metrics_server = metrics.serve(int(config['TT_METRICS_PORT']),
+                                                config.get('TT_METRICS_ADDR', '127.0.0.1'))
+        elif config.get('TT_METRICS', '').lower() in ('1', 'true', 'yes', 'on'):
+            metrics.enable()
         self.manager = api.MindManager(config['TT_CERT_PATH'],
                                        config['TT_CERT_PWD'],
                                        config['TT_TIVO_ADDR'],
-                                       rpc.MRPCCredential.new_mak(config['TT_TIVO_MAK']))
-        self.com = Communicator(config['TT_PUBKEY'],
-                                config['TT_SUBKEY'],
-                                client_id=config['TT_CLIENT_ID'])
+                                       rpc.MRPCCredential.new_mak(config['TT_TIVO_MAK']),
+                                       port=int(config.get('TT_TIVO_PORT', 1413)),
+                                       size=int(config.get('TT_POOL_SIZE', 4)),
+                                       reserved=int(config.get('TT_RESERVED_SESSIONS', 1)),
+                                       keep_warm=int(config.get('TT_KEEP_WARM', 0)),
+                                       parallel_pages=int(config.get('TT_PARALLEL_PAGES', 4)),
+                                       cache=cache.QueryCache(max_entries=int(config.get('TT_CACHE_SIZE', 256))))
+        self.com = Communicator(transport=transport_from_config(config, listen=True))
         self.com.swap_channels()
+        workers = int(config.get('TT_WORKERS', 4))
+        self.dispatcher = CommandDispatcher(self.handle, self.com.publish,
+                                            workers=workers,
+                                            max_queue=int(config.get('TT_MAX_QUEUE', 32)),
+                                            joinable=self.joins_flight)
+        searches = sum(self.dispatcher.limits.values())
+        if searches >= workers or searches >= self.manager.size:
+            logger.warning('{:d} concurrent searches are allowed with {:d} workers and {:d} sessions; other '
+                           'commands may wait behind them.'.format(searches, workers, self.manager.size))
+        self.manager.prewarm()
+        self.store = None
+        self.sync = None
+        if config.get('TT_STORE_PATH'):
+            self.store = store.MindStore(config['TT_STORE_PATH'])
+            self.sync = store.MindSync(self.store, self.manager,
+                                       interval=int(config.get('TT_SYNC_INTERVAL', 1800)),
+                                       horizon=int(config.get('TT_SYNC_HORIZON', 12 * 3600)))
+        self.recordings = RecordingIndex(ttl=int(config.get('TT_RECORDING_TTL', 300)))
+        self.recording_horizon = int(config.get('TT_RECORDING_HORIZON', 7 * 24 * 3600))
+        self.warm_lock = threading.Lock()
+        self.warming = False
+        self.flights = SingleFlight(on_lead=lambda key: self.dispatcher.lead(key[0]))
+        self.chunk_bytes = int(config.get('TT_CHUNK_BYTES', ChunkedResult.MAX_BYTES))
+        self.chunk_items = int(config.get('TT_CHUNK_ITEMS', ChunkedResult.MAX_ITEMS))
+        self.compress_bytes = int(config.get('TT_COMPRESS_BYTES', wire.COMPRESS_BYTES))
         self.tz = config.get('TT_TIVO_TZ', LOCAL_TZ)
-        self.channels = {'c_num': {}, 'c_name': {}}
         try:
-            with open('channels.json', 'rt') as cf:
-                channel_data = json.load(cf)
+            self.lineup = Lineup.load('channels.json')
         except FileNotFoundError:
             logger.warning('Channel Info Not Found, Downloading from TiVo...')
             with self.manager.mind() as m:
                 channel_data = m.channel_search()
                 with open('channels.json', 'wt') as cf:
                     json.dump(channel_data, cf)
-        self.channels['c_num'] = {c['channelNumber']: c for c in channel_data if c['isReceived']}
-        self.channels['c_name']= {c['name']: c for c in channel_data if c['isReceived']}
+            self.lineup = Lineup.from_channels(channel_data, source='channels.json')
+            self.lineup.save('channels.json.lineup')
+        self.channel_index = ChannelIndex(self.lineup)
 
     def run(self):
+        if self.sync is not None:
+            self.sync.start()
         self.com.connect()
         if self.com.connected.wait(timeout=3.0):
             while True:
@@ -62,89 +123,167 @@ class TiVoProxy(object):
                 self.com.messages.task_done()
                 logger.info("Received message...")
                 if 'cmd' in msg:
-                    logger.info('Processing command...')
-                    h = getattr(self, 'do_cmd_{}'.format(msg['cmd'].lower()), self.do_cmd_default)
-                    r = h(msg)
-                    logger.debug('Result: {}'.format(str(r)))
-                    if r is not None:
-                        logger.info('Sending response...')
-                        self.com.publish(message=r)
+                    logger.info('Queueing command...')
+                    self.dispatcher.submit(msg)
                 else:
                     logger.warning('Message contained no command: {}'.format(str(msg)))
         else:
             raise ConnectionError('Failed to connect to PubNub.')
 
+    def handle(self, msg):
+        logger.info('Processing command...')
+        h = getattr(self, 'do_cmd_{}'.format(msg['cmd'].lower()), self.do_cmd_default)
+        return h(msg)
+
+    def chunked(self, msg, list_key, items):
+        return ChunkedResult({'cmd': msg['cmd'], 'status': 'SUCCESS'}, list_key, items,
+                             max_bytes=self.chunk_bytes, max_items=self.chunk_items,
+                             packed=wire.supports(msg), compress_bytes=self.compress_bytes)
+
     def do_cmd_default(self, msg):
         logger.warning('Unknown command received: {}'.format(msg['cmd']))
 
     def do_cmd_pause(self, msg):
-        with self.manager.mind() as m:
+        with self.manager.mind(priority=True) as m:
             result = m.send_key('pause')
             return {'cmd': msg['cmd'], 'status': result['type'].upper()}
 
     def do_cmd_resume(self, msg):
-        with self.manager.mind() as m:
+        with self.manager.mind(priority=True) as m:
             result = m.send_key('play')
             return {'cmd': msg['cmd'], 'status': result['type'].upper()}
 
     def do_cmd_advance(self, msg):
-        with self.manager.mind() as m:
+        with self.manager.mind(priority=True) as m:
             result = m.send_key('advance')
             return {'cmd': msg['cmd'], 'status': result['type'].upper()}
 
+    def flight_key(self, msg):
+        # The normalized search a WHENIS/WHATSON would run; identical keys share one in-flight search.
+        cmd = msg['cmd'].upper()
+        if cmd == 'WHATSON':
+            return self.whatson_key(*self.whatson_window(msg))
+        if cmd == 'WHENIS':
+            return self.whenis_key(msg['title'], *self.whenis_query(msg))
+        return None
+
+    @staticmethod
+    def whatson_key(start, end):
+        return 'WHATSON', to_epoch(start), to_epoch(end)
+
+    @staticmethod
+    def whenis_key(title, station_id, start, end):
+        return 'WHENIS', ' '.join(title.lower().split()), station_id, to_epoch(start), to_epoch(end)
+
+    def joins_flight(self, msg):
+        key = self.flight_key(msg)
+        return key is not None and self.flights.active(key)
+
+    def whatson_window(self, msg):
+        dates = utils.parse_date(msg.get('rec_time'))
+        if not isinstance(dates, tuple):
+            dates = (dates, dates + datetime.timedelta(days=1))
+        return arrow.get(dates[0], self.tz), arrow.get(dates[1], self.tz)
+
     def do_cmd_whatson(self, msg):
+        start, end = self.whatson_window(msg)
+        if self.sync is not None and self.sync.recordings_fresh:
+            recordings = self.store.find_recordings(to_epoch(start), to_epoch(end))
+            return self.chunked(msg, 'recordings', [(r['title'], r['contentId']) for r in recordings])
+        result = self.recordings.find(to_epoch(start), to_epoch(end))
+        if result is None:
+            f = api.SearchFilter()
+            f.by_start_time(min_utc_time=start.to('UTC'), max_utc_time=end.to('UTC'))
+            f.set_projection(PROJECTIONS['WHATSON'])
+            result = self.flights.iter(self.whatson_key(start, end), self.iter_recordings(f))
+        return self.chunked(msg, 'recordings', result)
+
+    def iter_recordings(self, f):
         with self.manager.mind() as m:
-            dates = utils.parse_date(msg.get('rec_time'))
-            if not isinstance(dates, tuple):
-                dates = (dates, dates + datetime.timedelta(days=1))
-            start = arrow.get(dates[0], self.tz)
-            end = arrow.get(dates[1], self.tz)
+            for r in m.iter_recording_search(filt=f):
+                yield RecordingIndex.entry(r)[1:]
+        self.warm_recordings()
+
+    def warm_recordings(self):
+        # Index everything scheduled over the horizon once the requester has its answer, so later
+        # questions (tomorrow, the weekend) are answered from the index rather than another search.
+        with self.warm_lock:
+            if self.warming or self.recording_horizon <= 0:
+                return
+            self.warming = True
+        threading.Thread(target=self.load_recordings, name='RecordingIndex-warm', daemon=True).start()
+
+    def load_recordings(self):
+        try:
+            low = arrow.now(self.tz).floor('day')
+            high = arrow.utcnow().shift(seconds=self.recording_horizon)
             f = api.SearchFilter()
-            f.set_response_template([{"type": "responseTemplate",
-                                      "typeName": "recording",
-                                      "fieldName": ["title", "contentId", "scheduledStartTime"]}])
-            recordings = m.recording_search(filt=f)
-            result = [(r['title'], r['contentId']) for r in recordings if arrow.get(r['scheduledStartTime']) >= start and arrow.get(r['scheduledStartTime']) <= end]
-            return {'cmd': msg['cmd'], 'status': 'SUCCESS', 'recordings': result, 'total_count': len(result)}
+            f.by_start_time(min_utc_time=low.to('UTC'), max_utc_time=high.to('UTC'))
+            f.set_projection(PROJECTIONS['WHATSON'])
+            with self.manager.mind(cached=False) as m:
+                entries = [RecordingIndex.entry(r) for r in m.iter_recording_search(filt=f)]
+            self.recordings.load(entries, to_epoch(low), to_epoch(high))
+        except Exception:
+            logger.exception('Failed to index upcoming recordings.')
+        finally:
+            with self.warm_lock:
+                self.warming = False
 
     def do_cmd_tellabout(self, msg):
-        fields = ["title", "subtitle", "seasonNumber", "episodeNum", "description"]
-        with self.manager.mind() as m:
-            details = []
-            for id in msg['content_ids']:
-                f = api.SearchFilter()
-                f.by_content_id(id)
-                f.set_response_template([{"type": "responseTemplate",
-                                          "typeName": "content",
-                                          "fieldName": fields}])
-                content = m.content_search(filt=f, limit=1)
-                if len(content) > 0:
-                    content = content[0]
-                details.append({k: content.get(k, None) for k in fields})
-            return {'cmd': msg['cmd'], 'status': 'SUCCESS', 'details': details, 'total_count': len(details)}
+        known = self.store.get_contents(msg['content_ids']) if self.store is not None else {}
+        missing = [id for id in msg['content_ids'] if id not in known]
+        if missing:
+            with self.manager.mind() as m:
+                for id, content in zip(missing, m.content_lookup_many(missing, PROJECTIONS['TELLABOUT'])):
+                    if content is not None:
+                        known[id] = content
+            if self.store is not None:
+                self.store.put_contents([known[id] for id in missing if id in known])
+        details = []
+        for id in msg['content_ids']:
+            content = known.get(id, {})
+            details.append({k: content.get(k, None) for k in TELLABOUT_FIELDS})
+        return self.chunked(msg, 'details', details)
+
+    def whenis_query(self, msg):
+        station_id = None
+        channel_params = {k: msg[k] for k in ('c_name', 'c_num') if msg[k] is not None}
+        for k, v in channel_params.items():
+            match = self.channel_index.match(k, v)
+            logger.debug('Channel Match: {}'.format(str(match)))
+            station_id = match.station_id
+            logger.debug("Using Channel: {}".format(station_id))
+        start, end = utils.parse_date(msg['rec_time'])
+        return station_id, arrow.get(start, self.tz), arrow.get(end, self.tz)
 
     def do_cmd_whenis(self, msg):
-        with self.manager.mind() as m:
-            f = api.SearchFilter()
-            f.by_title(msg['title'])
-            channel_params = {k: msg[k] for k in ('c_name', 'c_num') if msg[k] is not None}
-            if channel_params:
-                for k, v in channel_params.items():
-                    options = self.channels[k].keys()
-                    options = [o for o in options if self.channels[k][o]['isHdtv']]
-                    match = process.extractOne(v, options)
-                    logger.debug('Channel Match: {}'.format(str(match)))
-                    f.by_station_id(self.channels[k][match[0]]['stationId'])
-                    logger.debug("Using Channel: {}".format(self.channels[k][match[0]]['stationId']))
-            start, end = utils.parse_date(msg['rec_time'])
-            start = arrow.get(start, self.tz)
-            end = arrow.get(end, self.tz)
+        f = api.SearchFilter()
+        f.by_title(msg['title'])
+        f.set_projection(PROJECTIONS['WHENIS'])
+        station_id, start, end = self.whenis_query(msg)
+        if station_id is not None:
+            f.by_station_id(station_id)
+        offers = []
+        if self.store is not None and self.store.covers(to_epoch(start), to_epoch(end),
+                                                        max_age=2 * self.sync.interval):
+            offers = self.store.find_offers(msg['title'], to_epoch(start), to_epoch(end),
+                                            station_id=station_id, limit=10)
+        if not offers:
             f.by_start_time(min_utc_time=start.to('UTC'), max_utc_time=end.to('UTC'))
-            keep_fields = ("title", "subtitle", "contentId", "offerId", "startTime", "channel")
-            offers = [{k: o[k] for k in keep_fields} for o in m.offer_search(filt=f, limit=10)]
-            for o in offers:
-                o['channel'] = o['channel']['name']
-            return {'cmd': msg['cmd'], 'status': 'SUCCESS', 'offers': offers, 'total_count': len(offers)}
+            offers = self.flights.iter(self.whenis_key(msg['title'], station_id, start, end),
+                                       self.iter_offers(f, limit=10))
+        return self.chunked(msg, 'offers', (self.offer_summary(o) for o in offers))
+
+    def iter_offers(self, f, limit=None):
+        with self.manager.mind() as m:
+            yield from m.iter_offer_search(filt=f, limit=limit)
+
+    @staticmethod
+    def offer_summary(offer):
+        keep_fields = ("title", "subtitle", "contentId", "offerId", "startTime", "channel")
+        summary = {k: offer[k] for k in keep_fields}
+        summary['channel'] = summary['channel']['name']
+        return summary
 
 
 if __name__ == '__main__':
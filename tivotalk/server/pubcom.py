@@ -1,57 +1,106 @@
-import logging
-from queue import Queue
+import collections
+from queue import Empty, Queue
 import threading
+import time
 import uuid
 
-from pubnub.enums import PNOperationType, PNStatusCategory
-from pubnub.callbacks import SubscribeCallback
-from pubnub.pnconfiguration import PNConfiguration
-from pubnub.pubnub import PubNub
+from tivotalk.server.transport import PubNubTransport
 
 
-class Communicator(SubscribeCallback):
+class RoundTripStats(object):
 
-    def __init__(self, pub_key, sub_key,
+    def __init__(self, size=256):
+        self.samples = collections.deque(maxlen=size)
+        self.fast = 0
+        self.slow = 0
+
+    def record(self, elapsed, fast):
+        self.samples.append(elapsed)
+        if fast:
+            self.fast += 1
+        else:
+            self.slow += 1
+
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def summary(self):
+        return {'count': len(self.samples), 'fast': self.fast, 'slow': self.slow,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99)}
+
+
+class PendingRequest(object):
+
+    def __init__(self, com, request_id):
+        self.com = com
+        self.id = request_id
+        self.responses = Queue()
+
+    def get(self, timeout=None):
+        try:
+            return self.responses.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError('No response to request {} within {} seconds.'.format(self.id, timeout))
+
+    def close(self):
+        self.com.forget(self.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Communicator(object):
+
+    def __init__(self, pub_key=None, sub_key=None,
                  publish_channel="C_QUERY", subscribe_channel="C_RESP",
-                 client_id=None, debug=False):
+                 client_id=None, debug=False, stale_after=240, connect_timeout=10, transport=None):
         self.messages = Queue()
         self.connected = threading.Event()
-        self.stop_key = str(uuid.uuid4())
+        self.lock = threading.Lock()
+        # A subscription idle this long (e.g. across a frozen Lambda container) is rebuilt before use.
+        self.stale_after = stale_after
+        self.last_seen = 0.0
+        self.connect_timeout = connect_timeout
+        self.connect_started = 0.0
+        self.round_trips = RoundTripStats()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.dropped = 0
 
         self.subscribe_channel = subscribe_channel
         self.publish_channel = publish_channel
 
-        self.pn = None
-
-        self.config = PNConfiguration()
-        self.config.publish_key = pub_key
-        self.config.subscribe_key = sub_key
-        self.config.uuid = client_id
+        if transport is None:
+            transport = PubNubTransport(pub_key, sub_key, client_id=client_id, debug=debug)
+        self.transport = transport
+        self.opened = False
 
-        self.debug = debug
-
-    def message(self, pubnub, message):
+    def on_message(self, message):
         msg = message.message
-        print('Message: {}'.format(msg))
-        if msg['cmd'] == 'STOP' and msg['key'] == self.stop_key:
-            pubnub.unsubscribe().channels(self.subscribe_channel).execute()
-            pubnub.remove_listener(self)
-            pubnub.stop()
+        self.last_seen = time.monotonic()
+        if 'status' in msg and 'id' in msg:
+            # A response: route it to its request, or drop it if that request has finished or timed out.
+            with self.pending_lock:
+                call = self.pending.get(msg['id'])
+                if call is None:
+                    self.dropped += 1
+            if call is not None:
+                call.responses.put(msg)
         else:
             self.messages.put(message)
 
-    def presence(self, pubnub, presence):
-        pass
+    def on_connected(self):
+        self.last_seen = time.monotonic()
+        self.connected.set()
 
-    def status(self, pubnub, status):
-        if status.operation in (PNOperationType.PNSubscribeOperation,
-                                PNOperationType.PNUnsubscribeOperation):
-            if status.category == PNStatusCategory.PNConnectedCategory:
-                print('Connected.')
-                self.connected.set()
-            elif status.category == PNStatusCategory.PNDisconnectedCategory:
-                print('Disconnected.')
-                self.connected.clear()
+    def on_disconnected(self):
+        self.connected.clear()
 
     def swap_channels(self):
         if not self.connected.is_set():
@@ -59,20 +108,60 @@ class Communicator(SubscribeCallback):
             self.publish_channel = self.subscribe_channel
             self.subscribe_channel = tmp
 
+    def is_alive(self):
+        return (self.opened and self.connected.is_set() and
+                time.monotonic() - self.last_seen < self.stale_after)
+
     def connect(self):
-        if not self.connected.is_set():
-            self.pn = PubNub(self.config)
-            if self.debug:
-                import pubnub
-                pubnub.set_stream_logger('pubnub', logging.DEBUG)
-            self.pn.add_listener(self)
-            self.pn.subscribe().channels(self.subscribe_channel).execute()
+        with self.lock:
+            if self.opened:
+                if self.connected.is_set():
+                    stale = not self.is_alive()
+                else:
+                    stale = time.monotonic() - self.connect_started > self.connect_timeout
+                if stale:
+                    self._teardown()
+            if not self.opened:
+                self.connect_started = time.monotonic()
+                self.opened = True
+                try:
+                    self.transport.open(self.subscribe_channel, self)
+                except BaseException:
+                    self._teardown()
+                    raise
+
+    def _teardown(self):
+        self.opened = False
+        self.connected.clear()
+        self.transport.close()
+
+    def ensure_connected(self, timeout=1.0):
+        # Returns (connected, fast); fast means a live subscription was reused without waiting.
+        if self.is_alive():
+            return True, True
+        self.connect()
+        return self.connected.wait(timeout=timeout), False
+
+    def request(self, message):
+        request_id = message.get('id') or uuid.uuid4().hex
+        call = PendingRequest(self, request_id)
+        with self.pending_lock:
+            self.pending[request_id] = call
+        try:
+            self.publish(dict(message, id=request_id))
+        except BaseException:
+            self.forget(request_id)
+            raise
+        return call
+
+    def forget(self, request_id):
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
 
     def disconnect(self):
-        if self.connected.is_set():
-            msg = {'cmd': 'STOP',
-                   'key': self.stop_key}
-            self.pn.publish().channel(self.subscribe_channel).message(msg).sync()
+        with self.lock:
+            if self.opened:
+                self._teardown()
 
     def wait_for_message(self, timeout=1.0):
         if self.connected.is_set():
@@ -84,6 +173,6 @@ class Communicator(SubscribeCallback):
 
     def publish(self, message):
         if self.connected.is_set():
-            self.pn.publish().channel(self.publish_channel).message(message).sync()
+            self.transport.send(self.publish_channel, message)
         else:
             raise ConnectionError('Not currently connected.')
@@ -0,0 +1,46 @@
+import bisect
+import operator
+import threading
+import time
+
+import tivotalk.mind.rpc as rpc
+
+
+class RecordingIndex(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.starts = []
+        self.entries = []
+        self.window = None
+        self.loaded = 0.0
+
+    @staticmethod
+    def entry(recording):
+        return rpc.MRPCSession.get_epoch(recording['scheduledStartTime']), recording['title'], recording['contentId']
+
+    def load(self, entries, start, end):
+        keyed = sorted(entries, key=operator.itemgetter(0))
+        with self.lock:
+            self.starts = [k[0] for k in keyed]
+            self.entries = [(k[1], k[2]) for k in keyed]
+            self.window = (start, end)
+            self.loaded = time.monotonic()
+
+    def covers(self, start, end):
+        return (self.window is not None and self.window[0] <= start and end <= self.window[1] and
+                time.monotonic() - self.loaded < self.ttl)
+
+    def find(self, start, end):
+        with self.lock:
+            if not self.covers(start, end):
+                return None
+            return self.between(start, end)
+
+    def between(self, start, end):
+        return self.entries[bisect.bisect_left(self.starts, start):bisect.bisect_right(self.starts, end)]
+
+    def invalidate(self):
+        with self.lock:
+            self.window = None
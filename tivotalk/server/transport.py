@@ -0,0 +1,276 @@
+import collections
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+from pubnub.enums import PNOperationType, PNStatusCategory
+from pubnub.callbacks import SubscribeCallback
+from pubnub.pnconfiguration import PNConfiguration
+from pubnub.pubnub import PubNub
+
+
+logger = logging.getLogger('tivoproxy')
+
+# The socket lives in a per-user directory that only that user can enter.
+DEFAULT_LOCAL_ADDRESS = 'unix:' + os.path.join(tempfile.gettempdir(), 'tivotalk-{:d}'.format(os.getuid()),
+                                               'tivotalk.sock')
+
+LocalMessage = collections.namedtuple('LocalMessage', ('channel', 'message'))
+
+
+class Transport(object):
+    """Moves JSON messages between named channels for a Communicator.
+
+    open() subscribes to one channel and reports to the listener through
+    on_message(envelope), on_connected() and on_disconnected(); envelopes
+    expose the decoded message as ``.message``.
+    """
+
+    def open(self, channel, listener):
+        raise NotImplementedError
+
+    def send(self, channel, message):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class PubNubTransport(Transport, SubscribeCallback):
+
+    def __init__(self, pub_key, sub_key, client_id=None, debug=False):
+        self.config = PNConfiguration()
+        self.config.publish_key = pub_key
+        self.config.subscribe_key = sub_key
+        self.config.uuid = client_id
+        self.debug = debug
+        self.pn = None
+        self.listener = None
+
+    def open(self, channel, listener):
+        self.listener = listener
+        self.pn = PubNub(self.config)
+        if self.debug:
+            import pubnub
+            pubnub.set_stream_logger('pubnub', logging.DEBUG)
+        self.pn.add_listener(self)
+        self.pn.subscribe().channels(channel).execute()
+
+    def send(self, channel, message):
+        self.pn.publish().channel(channel).message(message).sync()
+
+    def close(self):
+        pn, self.pn = self.pn, None
+        if pn is None:
+            return
+        pn.remove_listener(self)
+        try:
+            pn.unsubscribe_all()
+            pn.stop()
+        except Exception:
+            pass
+
+    def message(self, pubnub, message):
+        print('Message: {}'.format(message.message))
+        self.listener.on_message(message)
+
+    def presence(self, pubnub, presence):
+        pass
+
+    def status(self, pubnub, status):
+        if status.operation in (PNOperationType.PNSubscribeOperation,
+                                PNOperationType.PNUnsubscribeOperation):
+            if status.category == PNStatusCategory.PNConnectedCategory:
+                print('Connected.')
+                self.listener.on_connected()
+            elif status.category == PNStatusCategory.PNDisconnectedCategory:
+                print('Disconnected.')
+                self.listener.on_disconnected()
+
+
+class LocalTransport(Transport):
+    """Length-prefixed JSON frames over a Unix domain socket or TCP.
+
+    For a skill handler and proxy on the same host (or LAN).  The proxy
+    listens; clients connect.  Like a PubNub channel, everything published
+    reaches every connected peer, and each side keeps only the frames for
+    the channel it opened.
+    """
+
+    header = struct.Struct('>I')
+
+    def __init__(self, address=DEFAULT_LOCAL_ADDRESS, listen=False):
+        self.address = address
+        self.listen = listen
+        self.channel = None
+        self.listener = None
+        self.server = None
+        self.path = None
+        self.peers = []
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+    @staticmethod
+    def parse_address(address):
+        if address.startswith('unix:'):
+            return socket.AF_UNIX, address[len('unix:'):]
+        host, _, port = address.rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+    def open(self, channel, listener):
+        self.channel = channel
+        self.listener = listener
+        family, address = self.parse_address(self.address)
+        if self.listen:
+            if family == socket.AF_UNIX:
+                self.private_directory(os.path.dirname(address))
+                self.remove_stale(address)
+            self.server = socket.socket(family, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(address)
+            if family == socket.AF_UNIX:
+                self.path = address
+                os.chmod(address, 0o600)
+            self.server.listen()
+            threading.Thread(target=self.accept_loop, args=(self.server,), name='LocalTransport-accept',
+                             daemon=True).start()
+        else:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError('Unable to connect to {}: {}'.format(self.address, e))
+            self.add_peer(sock)
+        listener.on_connected()
+
+    @staticmethod
+    def private_directory(path):
+        # Anyone who can reach the socket can send commands and read responses, so it must be bound
+        # in a directory only this user can enter.
+        path = path or '.'
+        if not os.path.isdir(path):
+            os.makedirs(path, mode=0o700)
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+            raise PermissionError('Refusing to listen in {}: it must be owned by this user with mode 0700.'
+                                  .format(path))
+
+    @staticmethod
+    def remove_stale(path):
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError('{} exists and is not a socket; check TT_LOCAL_ADDR.'.format(path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # Left behind by a proxy that exited without closing.
+            os.unlink(path)
+        else:
+            raise ConnectionError('Another proxy is already listening on {}.'.format(path))
+        finally:
+            probe.close()
+
+    @property
+    def port(self):
+        return self.server.getsockname()[1] if self.server is not None else None
+
+    def add_peer(self, sock):
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.peers.append(sock)
+        threading.Thread(target=self.read_loop, args=(sock,), name='LocalTransport-read', daemon=True).start()
+
+    def accept_loop(self, server):
+        while True:
+            try:
+                sock, _ = server.accept()
+            except OSError:
+                return
+            self.add_peer(sock)
+
+    @staticmethod
+    def recv_exactly(sock, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('Peer closed the connection.')
+            data.extend(chunk)
+        return data
+
+    def read_loop(self, sock):
+        try:
+            while True:
+                size, = self.header.unpack(self.recv_exactly(sock, self.header.size))
+                frame = json.loads(self.recv_exactly(sock, size).decode('utf-8'))
+                if frame['channel'] == self.channel:
+                    self.listener.on_message(LocalMessage(frame['channel'], frame['message']))
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            self.drop_peer(sock)
+
+    def drop_peer(self, sock):
+        with self.lock:
+            if sock not in self.peers:
+                return
+            self.peers.remove(sock)
+            last = not self.peers
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if last and not self.listen:
+            self.listener.on_disconnected()
+
+    def send(self, channel, message):
+        data = json.dumps({'channel': channel, 'message': message}).encode('utf-8')
+        frame = self.header.pack(len(data)) + data
+        with self.lock:
+            peers = list(self.peers)
+        if not peers and not self.listen:
+            raise ConnectionError('Not connected to {}.'.format(self.address))
+        for sock in peers:
+            try:
+                with self.send_lock:
+                    sock.sendall(frame)
+            except OSError:
+                logger.warning('Dropping local peer after a failed send.')
+                self.drop_peer(sock)
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is not None:
+            server.close()
+        path, self.path = self.path, None
+        if path is not None and os.path.exists(path):
+            # Only a socket this transport bound; never another proxy's.
+            os.unlink(path)
+        with self.lock:
+            peers, self.peers = self.peers, []
+        for sock in peers:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+
+
+def transport_from_config(config, listen=False):
+    kind = config.get('TT_TRANSPORT', 'pubnub').lower()
+    if kind == 'pubnub':
+        return PubNubTransport(config['TT_PUBKEY'], config['TT_SUBKEY'], client_id=config.get('TT_CLIENT_ID'))
+    if kind == 'local':
+        return LocalTransport(config.get('TT_LOCAL_ADDR', DEFAULT_LOCAL_ADDRESS), listen=listen)
+    raise ValueError('Unknown transport: {}'.format(kind))
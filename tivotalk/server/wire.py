@@ -0,0 +1,80 @@
+import base64
+import json
+import zlib
+
+
+# Clients that send 'v': VERSION (or higher) with a command get list results
+# packed with pack_list; anything else gets the plain JSON lists.
+VERSION = 2
+
+COMPRESS_BYTES = 1024
+
+# schema id: (list key, fields, interned fields).  Integer fields index into
+# positional items, so recordings (title, contentId) pairs round-trip as lists.
+SCHEMAS = {
+    1: ('offers', ('title', 'subtitle', 'contentId', 'offerId', 'startTime', 'channel'), ('title', 'channel')),
+    2: ('details', ('title', 'subtitle', 'seasonNumber', 'episodeNum', 'description'), ('title',)),
+    3: ('recordings', (0, 1), (0,)),
+}
+SCHEMA_IDS = {key: schema_id for schema_id, (key, _, _) in SCHEMAS.items()}
+
+
+def supports(msg):
+    try:
+        return int(msg.get('v', 1)) >= VERSION
+    except (TypeError, ValueError):
+        return False
+
+
+def pack_list(list_key, items, compress_bytes=COMPRESS_BYTES):
+    """Packs a result list as {'s': schema id, 'k': strings, 'r': rows}.
+
+    Rows hold field values positionally, with interned fields replaced by an
+    index into 'k'.  When the packed JSON is over ``compress_bytes`` and
+    deflate makes it smaller, the result is {'z': base64 deflate} instead.
+    Lists without a schema are returned as they are.
+    """
+    schema_id = SCHEMA_IDS.get(list_key)
+    if schema_id is None:
+        return list(items)
+    _, fields, interned = SCHEMAS[schema_id]
+    strings = []
+    index = {}
+    rows = []
+    for item in items:
+        row = []
+        for field in fields:
+            value = item[field]
+            if field in interned and isinstance(value, str):
+                i = index.get(value)
+                if i is None:
+                    i = index[value] = len(strings)
+                    strings.append(value)
+                value = i
+            row.append(value)
+        rows.append(row)
+    packed = {'s': schema_id, 'k': strings, 'r': rows}
+    data = json.dumps(packed, separators=(',', ':')).encode('utf-8')
+    if compress_bytes is not None and len(data) > compress_bytes:
+        z = base64.b64encode(zlib.compress(data)).decode('ascii')
+        if len(z) < len(data):
+            return {'z': z}
+    return packed
+
+
+def unpack_list(value):
+    """Reverses pack_list; plain lists (older proxies and sessions) pass through."""
+    if isinstance(value, list):
+        return value
+    if 'z' in value:
+        value = json.loads(zlib.decompress(base64.b64decode(value['z'])).decode('utf-8'))
+    try:
+        _, fields, interned = SCHEMAS[value['s']]
+    except KeyError:
+        raise ValueError('Unknown wire schema: {}'.format(value.get('s')))
+    strings = value['k']
+    items = []
+    for row in value['r']:
+        row = [strings[v] if f in interned and isinstance(v, int) else v for f, v in zip(fields, row)]
+        items.append(row if isinstance(fields[0], int) else dict(zip(fields, row)))
+    return items